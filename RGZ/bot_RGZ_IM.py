@@ -1,34 +1,67 @@
 import os
+import sys
+import io
+import gzip
 import asyncio
 import logging
-from aiogram import Bot, Dispatcher, types
-from aiogram.filters import Command
+from contextlib import aclosing
+from aiogram import Bot, Dispatcher, F, types
+from aiogram.filters import Command, StateFilter
+from aiogram.filters.callback_data import CallbackData
 from aiogram.fsm.context import FSMContext
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton
-from aiogram.utils.keyboard import ReplyKeyboardBuilder
+from aiogram.types import (Message, CallbackQuery, ReplyKeyboardMarkup, KeyboardButton,
+                           InlineKeyboardButton, BufferedInputFile)
+from aiogram.utils.keyboard import InlineKeyboardBuilder, ReplyKeyboardBuilder
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
 import asyncpg
-from datetime import datetime, timedelta
-import aiohttp
+from datetime import date, datetime, timedelta
+from typing import List, Optional
 from dotenv import load_dotenv
 
+# Общие модули ботов лежат в каталоге common в корне репозитория
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.fsm_storage import create_fsm_storage
+from common.logging_setup import setup_logging
+
+from currency_client import CurrencyClient, RateHistory
+from digests import DIGEST_PERIODS, DigestScheduler, period_bounds
+from importer import ImportTooLargeError, import_operations, parse_operations_file
+from metrics import MetricsMiddleware, register_runtime_metrics, start_metrics_server
+from migrations import find_missing_indexes, run_migrations
+from outbound import OutboundQueue
+from middlewares import ThrottlingMiddleware, TTLCache, UserMiddleware
+from reports import SUMMARY_BUCKETS, convert_summary, format_age, format_summary, iter_report_chunks
+from repository import FinanceRepository
+from write_behind import OperationWriter
+
 # Загрузка переменных окружения
 load_dotenv()
 
 # Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.FileHandler("finance_bot.log"),
-        logging.StreamHandler()
-    ]
-)
+setup_logging("finance_bot.log")
 logger = logging.getLogger(__name__)
 
 # Конфигурация
 BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
+# Режим получения обновлений: polling или webhook
+BOT_MODE = os.getenv('BOT_MODE', 'polling').lower()
+WEBHOOK_CONFIG = {
+    'host': os.getenv('WEBHOOK_HOST', '0.0.0.0'),
+    'port': int(os.getenv('WEBHOOK_PORT', '8080')),
+    'path': os.getenv('WEBHOOK_PATH', '/webhook'),
+    # Публичный адрес, который регистрируется в Telegram (без пути)
+    'url': os.getenv('WEBHOOK_URL'),
+    # Обязателен: без него endpoint принимает обновления от кого угодно
+    'secret': os.getenv('WEBHOOK_SECRET'),
+    # Позволяет нескольким процессам слушать один порт (только Linux)
+    'reuse_port': os.getenv('WEBHOOK_REUSE_PORT', '0') == '1',
+}
+# Хранилище данных: postgres или sqlite (файл DB_SQLITE_PATH в режиме WAL,
+# для установки на одном сервере без отдельного сервера БД)
+DB_BACKEND = os.getenv('DB_BACKEND', 'postgres').lower()
+DB_SQLITE_PATH = os.getenv('DB_SQLITE_PATH', 'finance.db')
 DB_CONFIG = {
     'host': os.getenv('DB_HOST'),
     'port': os.getenv('DB_PORT'),
@@ -36,12 +69,117 @@ DB_CONFIG = {
     'password': os.getenv('DB_PASSWORD'),
     'database': os.getenv('DB_NAME')
 }
+DB_POOL_CONFIG = {
+    'min_size': int(os.getenv('DB_POOL_MIN_SIZE', '2')),
+    'max_size': int(os.getenv('DB_POOL_MAX_SIZE', '10')),
+}
+DB_ACQUIRE_TIMEOUT = float(os.getenv('DB_ACQUIRE_TIMEOUT', '5'))
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '100000'))
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', '300'))
+# Ограничение частоты запросов: ведро на THROTTLE_BURST жетонов на чат,
+# пополняется на THROTTLE_RATE жетонов в секунду
+THROTTLE_CONFIG = {
+    'rate': float(os.getenv('THROTTLE_RATE', '1')),
+    'burst': float(os.getenv('THROTTLE_BURST', '20')),
+    'maxsize': int(os.getenv('THROTTLE_CACHE_SIZE', '1000000')),
+}
+# Стоимость обработчиков в жетонах (остальные стоят 1)
+THROTTLE_COSTS = {
+    'report': 5,
+    'export': 5,
+    'import': 10,
+    'operations_list': 2,
+}
+# Отложенная пакетная запись операций (включается WRITE_BEHIND=1)
+WRITE_BEHIND = os.getenv('WRITE_BEHIND', '0') == '1'
+WRITE_BEHIND_CONFIG = {
+    'max_batch': int(os.getenv('WRITE_BEHIND_MAX_BATCH', '500')),
+    'max_delay': float(os.getenv('WRITE_BEHIND_MAX_DELAY', '0.05')),
+}
 CURRENCY_SERVICE_URL = os.getenv('CURRENCY_SERVICE_URL')
+CURRENCY_CLIENT_CONFIG = {
+    'ttl': float(os.getenv('RATE_CACHE_TTL', '600')),
+    'stale_ttl': float(os.getenv('RATE_STALE_TTL', '3600')),
+    'pool_size': int(os.getenv('CURRENCY_HTTP_POOL_SIZE', '100')),
+    # После стольких ошибок подряд запросы к сервису приостанавливаются
+    # на RATE_CIRCUIT_RESET секунд и отдаются последние полученные курсы
+    'failure_threshold': int(os.getenv('RATE_FAILURE_THRESHOLD', '3')),
+    'reset_timeout': float(os.getenv('RATE_CIRCUIT_RESET', '30')),
+    # Сколько секунд после неудачного запроса курсов не ждать сервис снова
+    'negative_ttl': float(os.getenv('RATE_NEGATIVE_TTL', '30')),
+}
+# Метрики Prometheus на отдельном порту (0 - отключены)
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+# Как часто сверять балансы с операциями, в секундах (0 - не сверять).
+# Сверка читает всю таблицу operations, поэтому по умолчанию выключена;
+# с Postgres за один проход ее выполняет только одна реплика бота
+BALANCE_RECONCILE_INTERVAL = float(os.getenv('BALANCE_RECONCILE_INTERVAL', '0'))
+# Рассылка дайджестов: период проверки в секундах (0 - отключена)
+# и час, раньше которого не отправлять; темп задает OUTBOUND_CONFIG
+DIGEST_CONFIG = {
+    'interval': float(os.getenv('DIGEST_CHECK_INTERVAL', '3600')),
+    'send_hour': int(os.getenv('DIGEST_SEND_HOUR', '9')),
+}
+# Исходящие сообщения: не больше OUTBOUND_GLOBAL_RATE в секунду всего
+# и OUTBOUND_CHAT_RATE в секунду в один чат (с запасом OUTBOUND_CHAT_BURST)
+OUTBOUND_CONFIG = {
+    'global_rate': float(os.getenv('OUTBOUND_GLOBAL_RATE', '30')),
+    'chat_rate': float(os.getenv('OUTBOUND_CHAT_RATE', '1')),
+    'chat_burst': float(os.getenv('OUTBOUND_CHAT_BURST', '5')),
+    'max_retries': int(os.getenv('OUTBOUND_MAX_RETRIES', '3')),
+}
+
+# Периоды отчетов и выгрузки
+PERIODS = {
+    "За сегодня": timedelta(days=1),
+    "За неделю": timedelta(weeks=1),
+    "За месяц": timedelta(days=30),
+    "За все время": None
+}
+EXPORT_FORMATS = {
+    "CSV": False,
+    "CSV (gzip)": True
+}
+IMPORT_MAX_ROWS = int(os.getenv('IMPORT_MAX_ROWS', '100000'))
+# Наибольший размер файла импорта после распаковки, в байтах
+IMPORT_MAX_BYTES = int(os.getenv('IMPORT_MAX_BYTES', str(10 * 1024 * 1024)))
+# Сколько ошибок разбора показывать пользователю
+IMPORT_MAX_ERRORS = 20
+# Операций на странице списка /update_operation
+OPERATIONS_PAGE_SIZE = 8
 
 # Инициализация бота
 bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
+outbound = OutboundQueue(**OUTBOUND_CONFIG)
+bot.session.middleware(outbound)
+storage = create_fsm_storage(DB_CONFIG)
 dp = Dispatcher(storage=storage)
+dp.update.outer_middleware(UserMiddleware(
+    TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+))
+throttling = ThrottlingMiddleware(**THROTTLE_CONFIG)
+dp.message.middleware(throttling)
+dp.callback_query.middleware(throttling)
+dp.message.middleware(MetricsMiddleware())
+dp.callback_query.middleware(MetricsMiddleware())
+
+
+# Данные inline-кнопок списка операций
+class OperationsPage(CallbackData, prefix="ops"):
+    """Переход к странице старше или новее операции (day, id)"""
+    older: bool
+    day: str
+    id: int
+
+
+class OperationChoice(CallbackData, prefix="op"):
+    id: int
+
+
+class DigestChoice(CallbackData, prefix="digest"):
+    """week, month или off"""
+    period: str
 
 
 # Состояния FSM
@@ -56,57 +194,59 @@ class AddOperationState(StatesGroup):
 
 
 class ReportState(StatesGroup):
+    waiting_for_mode = State()
     waiting_for_currency = State()
     waiting_for_period = State()
 
 
+class ExportState(StatesGroup):
+    waiting_for_format = State()
+    waiting_for_period = State()
+
+
 class UpdateOperationState(StatesGroup):
     waiting_for_operation_id = State()
     waiting_for_new_amount = State()
 
 
 # Подключение к бд БД
-async def create_db_connection():
-    """Создает подключение к базе данных"""
-    return await asyncpg.connect(**DB_CONFIG)
+async def create_db_pool():
+    """Создает пул подключений к базе данных (один на весь процесс)"""
+    if DB_BACKEND == 'sqlite':
+        from sqlite_repository import create_sqlite_pool
+
+        return await create_sqlite_pool(DB_SQLITE_PATH, size=DB_POOL_CONFIG['max_size'],
+                                        busy_timeout=DB_ACQUIRE_TIMEOUT)
+    return await asyncpg.create_pool(**DB_CONFIG, **DB_POOL_CONFIG)
 
-async def init_db():
-    conn = None
-    try:
-        conn = await create_db_connection()
-        await conn.execute("SELECT 1 FROM users LIMIT 1")
-        await conn.execute("SELECT 1 FROM operations LIMIT 1")
-        logger.info("Подключение к базе данных успешно")
-    except Exception as e:
-        logger.error(f"Ошибка при проверке таблиц: {str(e)}")
-        exit(1)
-    finally:
-        if conn:
-            await conn.close()
 
+def create_repository(db_pool) -> FinanceRepository:
+    """Репозиторий для выбранного в DB_BACKEND хранилища"""
+    if DB_BACKEND == 'sqlite':
+        from sqlite_repository import SQLiteRepository
 
-# Работы с API
-async def get_exchange_rate(currency: str) -> float:
-    """Получает курс валюты от микросервиса"""
-    if currency == 'RUB':
-        return 1.0
+        return SQLiteRepository(db_pool, acquire_timeout=DB_ACQUIRE_TIMEOUT)
+    return FinanceRepository(db_pool, acquire_timeout=DB_ACQUIRE_TIMEOUT)
 
+
+async def init_db(db_pool):
+    """Применяет миграции схемы и проверяет наличие нужных индексов"""
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                    f"{CURRENCY_SERVICE_URL}/rate?currency={currency}",
-                    timeout=3
-            ) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    return float(data['rate'])
-
-                logger.warning(f"Не удалось получить курс валюты. Код ответа: {response.status}")
-                return None
+        if DB_BACKEND == 'sqlite':
+            from sqlite_repository import find_missing_sqlite_indexes, run_sqlite_migrations
 
+            await run_sqlite_migrations(db_pool)
+            missing_indexes = await find_missing_sqlite_indexes(db_pool)
+        else:
+            async with db_pool.acquire(timeout=DB_ACQUIRE_TIMEOUT) as conn:
+                await run_migrations(conn)
+                missing_indexes = await find_missing_indexes(conn)
+        for index in missing_indexes:
+            logger.warning(f"В базе нет индекса {index}, запросы отчетов будут медленными")
+        logger.info("Подключение к базе данных успешно")
     except Exception as e:
-        logger.error(f"Ошибка при получении курса валюты: {str(e)}")
-        return None
+        logger.error(f"Ошибка при проверке таблиц: {str(e)}")
+        exit(1)
 
 
 # Клавиатуры
@@ -114,9 +254,11 @@ def get_main_keyboard():
     builder = ReplyKeyboardBuilder()
     builder.row(
         KeyboardButton(text="➕ Добавить операцию"),
-        KeyboardButton(text="📊 Отчеты")
+        KeyboardButton(text="📊 Отчеты"),
+        KeyboardButton(text="📤 Экспорт")
     )
     builder.row(
+        KeyboardButton(text="💰 Баланс"),
         KeyboardButton(text="ℹ️ Помощь")
     )
     return builder.as_markup(resize_keyboard=True)
@@ -133,19 +275,85 @@ def get_operation_type_keyboard():
     return builder.as_markup(resize_keyboard=True)
 
 
-def get_currency_keyboard():
+def get_report_mode_keyboard():
     builder = ReplyKeyboardBuilder()
     builder.add(
-        KeyboardButton(text="RUB"),
-        KeyboardButton(text="USD"),
-        KeyboardButton(text="EUR"),
-        KeyboardButton(text="CNY"),
+        KeyboardButton(text="📈 Сводка"),
+        KeyboardButton(text="📋 Подробно"),
         KeyboardButton(text="Отмена")
     )
+    builder.adjust(2)
+    return builder.as_markup(resize_keyboard=True)
+
+
+def get_currency_keyboard(currencies: List[str]):
+    builder = ReplyKeyboardBuilder()
+    for currency in currencies:
+        builder.add(KeyboardButton(text=currency))
+    builder.add(KeyboardButton(text="Отмена"))
     builder.adjust(3)
     return builder.as_markup(resize_keyboard=True)
 
 
+def get_period_keyboard():
+    return ReplyKeyboardMarkup(
+        keyboard=[
+            [KeyboardButton(text="За сегодня"), KeyboardButton(text="За неделю")],
+            [KeyboardButton(text="За месяц"), KeyboardButton(text="За все время")],
+            [KeyboardButton(text="Отмена")]
+        ],
+        resize_keyboard=True
+    )
+
+
+def get_export_format_keyboard():
+    builder = ReplyKeyboardBuilder()
+    for export_format in EXPORT_FORMATS:
+        builder.add(KeyboardButton(text=export_format))
+    builder.add(KeyboardButton(text="Отмена"))
+    builder.adjust(2)
+    return builder.as_markup(resize_keyboard=True)
+
+
+def get_operations_keyboard(operations, has_older: bool, has_newer: bool):
+    """Кнопки операций страницы и перехода к соседним страницам"""
+    builder = InlineKeyboardBuilder()
+    for op in operations:
+        prefix = "⬆️" if op['type_operation'] == 'income' else "⬇️"
+        builder.row(InlineKeyboardButton(
+            text=f"{prefix} {op['date'].strftime('%d.%m.%Y')} - {op['sum']:.2f} RUB (🆔 {op['id']})",
+            callback_data=OperationChoice(id=op['id']).pack()
+        ))
+
+    # Курсор - первая или последняя операция текущей страницы
+    navigation = []
+    if has_newer:
+        first = operations[0]
+        navigation.append(InlineKeyboardButton(
+            text="⬅️ Новее",
+            callback_data=OperationsPage(older=False, day=first['date'].isoformat(), id=first['id']).pack()
+        ))
+    if has_older:
+        last = operations[-1]
+        navigation.append(InlineKeyboardButton(
+            text="Старее ➡️",
+            callback_data=OperationsPage(older=True, day=last['date'].isoformat(), id=last['id']).pack()
+        ))
+    if navigation:
+        builder.row(*navigation)
+    builder.row(InlineKeyboardButton(text="❌ Отмена", callback_data="ops_cancel"))
+    return builder.as_markup()
+
+
+def get_digest_keyboard():
+    builder = InlineKeyboardBuilder()
+    for period, title in DIGEST_PERIODS.items():
+        builder.add(InlineKeyboardButton(text=title, callback_data=DigestChoice(period=period).pack()))
+    builder.add(InlineKeyboardButton(text="Отключить", callback_data=DigestChoice(period="off").pack()))
+    builder.adjust(2)
+    return builder.as_markup()
+
+
 def get_cancel_keyboard():
     return ReplyKeyboardMarkup(
         keyboard=[[KeyboardButton(text="Отмена")]],
@@ -155,78 +363,109 @@ def get_cancel_keyboard():
 
 # Обработчики команд
 @dp.message(Command('start'))
-async def cmd_start(message: Message):
+async def cmd_start(message: Message, user_registered: bool):
     """Обработчик команды /start"""
-    conn = None
-    try:
-        conn = await create_db_connection()
-        user_exists = await conn.fetchval(
-            "SELECT 1 FROM users WHERE chat_id = $1",
-            message.from_user.id
+    if not user_registered:
+        await message.answer(
+            "👋 Добро пожаловать в Finance Bot!\n\n"
+            "Пожалуйста, зарегистрируйтесь с помощью команды /register"
+        )
+    else:
+        await message.answer(
+            "🔄 Бот уже запущен\n"
+            "Используйте кнопки ниже для работы",
+            reply_markup=get_main_keyboard()
         )
-
-        if not user_exists:
-            await message.answer(
-                "👋 Добро пожаловать в Finance Bot!\n\n"
-                "Пожалуйста, зарегистрируйтесь с помощью команды /register"
-            )
-        else:
-            await message.answer(
-                "🔄 Бот уже запущен\n"
-                "Используйте кнопки ниже для работы",
-                reply_markup=get_main_keyboard()
-            )
-    except Exception as e:
-        logger.error(f"Ошибка при обработке /start: {str(e)}")
-        await message.answer("⚠️ Произошла ошибка. Пожалуйста, попробуйте позже.")
-    finally:
-        if conn:
-            await conn.close()
 
 
 @dp.message(Command('register'))
-async def cmd_register(message: Message, state: FSMContext):
+async def cmd_register(message: Message, state: FSMContext, user_registered: bool):
     """Обработчик команды /register"""
-    conn = None
-    try:
-        conn = await create_db_connection()
-        user_exists = await conn.fetchval(
-            "SELECT 1 FROM users WHERE chat_id = $1",
-            message.from_user.id
-        )
+    if user_registered:
+        await message.answer("ℹ️ Вы уже зарегистрированы!")
+        return
 
-        if user_exists:
-            await message.answer("ℹ️ Вы уже зарегистрированы!")
-            return
+    await message.answer(
+        "📝 Введите ваше имя для регистрации:",
+        reply_markup=get_cancel_keyboard()
+    )
+    await state.set_state(RegistrationState.waiting_for_name)
+
+
+# Файл импорта принимается в любом состоянии, поэтому обработчик
+# зарегистрирован раньше обработчиков состояний: иначе документ попадет,
+# например, в ввод суммы и будет молча проигнорирован
+@dp.message(F.document, StateFilter('*'), flags={'throttle_cost': THROTTLE_COSTS['import']})
+async def process_import_file(message: Message, state: FSMContext, repo: FinanceRepository,
+                              user_registered: bool):
+    """Импорт операций из присланного CSV-файла"""
+    if not user_registered:
+        await message.answer("ℹ️ Пожалуйста, сначала зарегистрируйтесь с помощью /register")
+        return
+
+    await state.clear()
+    filename = (message.document.file_name or "").lower()
+    if not filename.endswith((".csv", ".csv.gz")):
+        await message.answer("⚠️ Поддерживаются только файлы .csv и .csv.gz")
+        return
 
+    try:
+        buffer = await message.bot.download(message.document, destination=io.BytesIO())
+        raw = gzip.GzipFile(fileobj=buffer) if filename.endswith(".gz") else buffer
+        # Распаковка и разбор идут в отдельном потоке, чтобы большой файл
+        # не останавливал обработку остальных обновлений
+        records, errors, error_count = await asyncio.to_thread(
+            parse_operations_file, raw, IMPORT_MAX_ROWS, IMPORT_MAX_ERRORS, IMPORT_MAX_BYTES
+        )
+    except ImportTooLargeError:
         await message.answer(
-            "📝 Введите ваше имя для регистрации:",
-            reply_markup=get_cancel_keyboard()
+            f"⚠️ Файл слишком большой: после распаковки он должен быть "
+            f"не больше {IMPORT_MAX_BYTES // (1024 * 1024)} МБ",
+            reply_markup=get_main_keyboard()
         )
-        await state.set_state(RegistrationState.waiting_for_name)
+        return
     except Exception as e:
-        logger.error(f"Ошибка при регистрации: {str(e)}")
-        await message.answer("⚠️ Произошла ошибка. Пожалуйста, попробуйте позже.")
-    finally:
-        if conn:
-            await conn.close()
+        logger.error(f"Ошибка при чтении файла импорта: {str(e)}")
+        await message.answer("⚠️ Не удалось прочитать файл. Проверьте, что это CSV в кодировке UTF-8.")
+        return
+
+    report_lines = []
+    if records:
+        try:
+            await import_operations(repo, message.from_user.id, records)
+            report_lines.append(f"✅ Импортировано операций: {len(records)}")
+        except Exception as e:
+            logger.error(f"Ошибка при импорте операций: {str(e)}")
+            await message.answer("⚠️ Произошла ошибка при импорте. Пожалуйста, попробуйте позже.")
+            return
+    else:
+        report_lines.append("ℹ️ В файле не найдено корректных операций")
+
+    if error_count:
+        report_lines.append(f"\n⚠️ Пропущено строк с ошибками: {error_count}")
+        report_lines.extend(errors)
+        if error_count > len(errors):
+            report_lines.append("...")
+
+    await message.answer("\n".join(report_lines), reply_markup=get_main_keyboard())
 
 
 @dp.message(RegistrationState.waiting_for_name)
-async def process_registration_name(message: Message, state: FSMContext):
+async def process_registration_name(message: Message, state: FSMContext, repo: FinanceRepository,
+                                    user_cache: TTLCache):
     """Обработка имени при регистрации"""
     if message.text == "Отмена":
         await state.clear()
         await message.answer("❌ Регистрация отменена", reply_markup=types.ReplyKeyboardRemove())
         return
 
-    conn = None
     try:
-        conn = await create_db_connection()
-        await conn.execute(
-            "INSERT INTO users (chat_id, name) VALUES ($1, $2)",
-            message.from_user.id, message.text.strip()
-        )
+        registered = await repo.register_user(message.from_user.id, message.text.strip())
+        user_cache.set(message.from_user.id, True)
+        if not registered:
+            await message.answer("ℹ️ Вы уже зарегистрированы!", reply_markup=get_main_keyboard())
+            return
+
         await message.answer(
             f"✅ Регистрация успешна, {message.text.strip()}!\n"
             "Теперь вы можете начать вести учет финансов.",
@@ -236,59 +475,82 @@ async def process_registration_name(message: Message, state: FSMContext):
         logger.error(f"Ошибка при завершении регистрации: {str(e)}")
         await message.answer("⚠️ Произошла ошибка при регистрации. Пожалуйста, попробуйте позже.")
     finally:
-        if conn:
-            await conn.close()
         await state.clear()
 
 
 # Обработчик команды /update_operation
-@dp.message(Command('update_operation'))
-async def cmd_update_operation(message: Message, state: FSMContext):
+@dp.message(Command('update_operation'), flags={'throttle_cost': THROTTLE_COSTS['operations_list']})
+async def cmd_update_operation(message: Message, state: FSMContext, repo: FinanceRepository,
+                               user_registered: bool):
     """Обработчик команды /update_operation с выводом списка операций"""
-    conn = None
-    try:
-        conn = await create_db_connection()
-        user_exists = await conn.fetchval(
-            "SELECT 1 FROM users WHERE chat_id = $1",
-            message.from_user.id
-        )
-
-        if not user_exists:
-            await message.answer("ℹ️ Пожалуйста, сначала зарегистрируйтесь с помощью /register")
-            return
+    if not user_registered:
+        await message.answer("ℹ️ Пожалуйста, сначала зарегистрируйтесь с помощью /register")
+        return
 
-        # Получаем последние 10 операций пользователя
-        operations = await conn.fetch(
-            "SELECT id, type_operation, sum, date FROM operations "
-            "WHERE chat_id = $1 ORDER BY date DESC, id DESC LIMIT 10",
-            message.from_user.id
-        )
+    try:
+        operations, has_older = await repo.operations_page(message.from_user.id, limit=OPERATIONS_PAGE_SIZE)
 
         if not operations:
             await message.answer("ℹ️ У вас пока нет операций для изменения")
             return
 
-        # Формируем сообщение со списком операций
-        operations_list = ["📋 Ваши последние операции (ID - Дата - Сумма - Тип):"]
-        for op in operations:
-            op_type = "Доход" if op['type_operation'] == 'income' else "Расход"
-            operations_list.append(
-                f"🆔 {op['id']} - {op['date'].strftime('%d.%m.%Y')} - {op['sum']:.2f} RUB - {op_type}"
-            )
-
-        operations_list.append("\nВведите ID операции, которую хотите изменить:")
-
+        # Список идет с inline-кнопками, а клавиатуру меню на время ввода ID
+        # заменяет кнопка отмены: иначе нажатия меню попадут в обработчик ID
+        await message.answer("✏️ Изменение операции", reply_markup=get_cancel_keyboard())
         await message.answer(
-            "\n".join(operations_list),
-            reply_markup=get_cancel_keyboard()
+            "📋 Ваши операции (новые сверху).\n"
+            "Выберите операцию, которую хотите изменить, или введите ее ID:",
+            reply_markup=get_operations_keyboard(operations, has_older, has_newer=False)
         )
         await state.set_state(UpdateOperationState.waiting_for_operation_id)
     except Exception as e:
         logger.error(f"Ошибка при начале обновления операции: {str(e)}")
         await message.answer("⚠️ Произошла ошибка. Пожалуйста, попробуйте позже.")
-    finally:
-        if conn:
-            await conn.close()
+
+
+# Листание списка операций
+@dp.callback_query(OperationsPage.filter(), flags={'throttle_cost': THROTTLE_COSTS['operations_list']})
+async def browse_operations(callback: CallbackQuery, callback_data: OperationsPage,
+                            repo: FinanceRepository):
+    """Показывает соседнюю страницу операций"""
+    try:
+        cursor = (date.fromisoformat(callback_data.day), callback_data.id)
+        operations, has_more = await repo.operations_page(
+            callback.from_user.id, cursor, older=callback_data.older, limit=OPERATIONS_PAGE_SIZE
+        )
+        if not operations:
+            await callback.answer("ℹ️ Больше операций нет")
+            return
+
+        # Страница, с которой пришли, находится с другой стороны от новой
+        if callback_data.older:
+            keyboard = get_operations_keyboard(operations, has_older=has_more, has_newer=True)
+        else:
+            keyboard = get_operations_keyboard(operations, has_older=True, has_newer=has_more)
+        await callback.message.edit_reply_markup(reply_markup=keyboard)
+        await callback.answer()
+    except Exception as e:
+        logger.error(f"Ошибка при листании операций: {str(e)}")
+        await callback.answer("⚠️ Произошла ошибка. Пожалуйста, попробуйте позже.")
+
+
+# Выбор операции кнопкой
+@dp.callback_query(OperationChoice.filter())
+async def choose_operation(callback: CallbackQuery, callback_data: OperationChoice, state: FSMContext):
+    """Выбор операции из списка; принадлежность пользователю проверяет запрос обновления"""
+    await state.update_data(operation_id=callback_data.id)
+    await state.set_state(UpdateOperationState.waiting_for_new_amount)
+    await callback.message.edit_text(f"✏️ Выбрана операция 🆔 {callback_data.id}")
+    await callback.message.answer("Введите новую сумму для операции:", reply_markup=get_cancel_keyboard())
+    await callback.answer()
+
+
+@dp.callback_query(F.data == "ops_cancel")
+async def cancel_operations_browser(callback: CallbackQuery, state: FSMContext):
+    await state.clear()
+    await callback.message.edit_text("❌ Изменение операции отменено")
+    await callback.message.answer("Выберите действие:", reply_markup=get_main_keyboard())
+    await callback.answer()
 
 
 # Обработка ID операции
@@ -300,21 +562,10 @@ async def process_operation_id(message: Message, state: FSMContext):
         await message.answer("❌ Изменение операции отменено", reply_markup=get_main_keyboard())
         return
 
-    conn = None
     try:
         operation_id = int(message.text)
-        conn = await create_db_connection()
-
-        # Проверяем, что операция существует и принадлежит пользователю
-        operation_exists = await conn.fetchval(
-            "SELECT 1 FROM operations WHERE id = $1 AND chat_id = $2",
-            operation_id, message.from_user.id
-        )
-
-        if not operation_exists:
-            await message.answer("⚠️ Операция с таким ID не найдена или не принадлежит вам. Попробуйте еще раз.")
-            return
 
+        # Существование и владельца проверяет само обновление (process_new_amount)
         await state.update_data(operation_id=operation_id)
         await message.answer(
             "Введите новую сумму для операции:",
@@ -326,14 +577,11 @@ async def process_operation_id(message: Message, state: FSMContext):
     except Exception as e:
         logger.error(f"Ошибка при проверке операции: {str(e)}")
         await message.answer("⚠️ Произошла ошибка. Пожалуйста, попробуйте позже.")
-    finally:
-        if conn:
-            await conn.close()
 
 
 # Обработка новой суммы операции
 @dp.message(UpdateOperationState.waiting_for_new_amount)
-async def process_new_amount(message: Message, state: FSMContext):
+async def process_new_amount(message: Message, state: FSMContext, repo: FinanceRepository):
     """Обработка новой суммы операции"""
     if message.text == "Отмена":
         await state.clear()
@@ -347,20 +595,14 @@ async def process_new_amount(message: Message, state: FSMContext):
             return
 
         operation_data = await state.get_data()
-        conn = None
 
         try:
-            conn = await create_db_connection()
-            await conn.execute(
-                "UPDATE operations SET sum = $1 WHERE id = $2 AND chat_id = $3",
-                new_amount, operation_data['operation_id'], message.from_user.id
-            )
-
-            # Получаем обновленную операцию для отображения пользователю
-            updated_operation = await conn.fetchrow(
-                "SELECT type_operation, sum, date FROM operations WHERE id = $1",
-                operation_data['operation_id']
+            updated_operation = await repo.update_operation_amount(
+                operation_data['operation_id'], message.from_user.id, new_amount
             )
+            if updated_operation is None:
+                await message.answer("⚠️ Операция с таким ID не найдена или не принадлежит вам", reply_markup=get_main_keyboard())
+                return
 
             operation_type = "доход" if updated_operation['type_operation'] == 'income' else "расход"
             await message.answer(
@@ -374,39 +616,23 @@ async def process_new_amount(message: Message, state: FSMContext):
             logger.error(f"Ошибка при обновлении операции: {str(e)}")
             await message.answer("⚠️ Произошла ошибка при обновлении операции. Пожалуйста, попробуйте позже.")
         finally:
-            if conn:
-                await conn.close()
             await state.clear()
     except ValueError:
         await message.answer("⚠️ Пожалуйста, введите корректную сумму (например: 1500.50)")
 
 
 @dp.message(lambda message: message.text == "➕ Добавить операцию")
-async def add_operation_start(message: Message, state: FSMContext):
+async def add_operation_start(message: Message, state: FSMContext, user_registered: bool):
     """Начало добавления операции"""
-    conn = None
-    try:
-        conn = await create_db_connection()
-        user_exists = await conn.fetchval(
-            "SELECT 1 FROM users WHERE chat_id = $1",
-            message.from_user.id
-        )
-
-        if not user_exists:
-            await message.answer("ℹ️ Пожалуйста, сначала зарегистрируйтесь с помощью /register")
-            return
+    if not user_registered:
+        await message.answer("ℹ️ Пожалуйста, сначала зарегистрируйтесь с помощью /register")
+        return
 
-        await message.answer(
-            "Выберите тип операции:",
-            reply_markup=get_operation_type_keyboard()
-        )
-        await state.set_state(AddOperationState.waiting_for_type)
-    except Exception as e:
-        logger.error(f"Ошибка при начале добавления операции: {str(e)}")
-        await message.answer("⚠️ Произошла ошибка. Пожалуйста, попробуйте позже.")
-    finally:
-        if conn:
-            await conn.close()
+    await message.answer(
+        "Выберите тип операции:",
+        reply_markup=get_operation_type_keyboard()
+    )
+    await state.set_state(AddOperationState.waiting_for_type)
 
 
 @dp.message(AddOperationState.waiting_for_type)
@@ -460,7 +686,8 @@ async def process_operation_amount(message: Message, state: FSMContext):
 
 
 @dp.message(AddOperationState.waiting_for_date)
-async def process_operation_date(message: Message, state: FSMContext):
+async def process_operation_date(message: Message, state: FSMContext, repo: FinanceRepository,
+                                 operation_writer: Optional[OperationWriter]):
     """Обработка даты операции"""
     if message.text == "Отмена":
         await state.clear()
@@ -468,7 +695,6 @@ async def process_operation_date(message: Message, state: FSMContext):
         return
 
     operation_data = await state.get_data()
-    conn = None
 
     try:
         if message.text == "Сегодня":
@@ -476,14 +702,21 @@ async def process_operation_date(message: Message, state: FSMContext):
         else:
             operation_date = datetime.strptime(message.text, "%d.%m.%Y").date()
 
-        conn = await create_db_connection()
-        await conn.execute(
-            "INSERT INTO operations (chat_id, type_operation, sum, date) VALUES ($1, $2, $3, $4)",
-            message.from_user.id,
-            operation_data['operation_type'],
-            operation_data['amount'],
-            operation_date
-        )
+        if operation_writer is not None:
+            # Операция сохраняется в общей пачке, ответ - после ее фиксации
+            await operation_writer.add(
+                message.from_user.id,
+                operation_data['operation_type'],
+                operation_data['amount'],
+                operation_date
+            )
+        else:
+            await repo.add_operation(
+                message.from_user.id,
+                operation_data['operation_type'],
+                operation_data['amount'],
+                operation_date
+            )
 
         operation_type = "доход" if operation_data['operation_type'] == 'income' else "расход"
         await message.answer(
@@ -500,134 +733,299 @@ async def process_operation_date(message: Message, state: FSMContext):
         logger.error(f"Ошибка при сохранении операции: {str(e)}")
         await message.answer("⚠️ Произошла ошибка при сохранении операции. Пожалуйста, попробуйте позже.")
     finally:
-        if conn:
-            await conn.close()
         await state.clear()
 
 
 @dp.message(lambda message: message.text == "📊 Отчеты")
 async def reports_menu(message: Message, state: FSMContext):
     """Меню отчетов"""
+    await message.answer(
+        "Выберите вид отчета:\n"
+        "📈 Сводка - итоги и разбивка по периодам\n"
+        "📋 Подробно - список всех операций",
+        reply_markup=get_report_mode_keyboard()
+    )
+    await state.set_state(ReportState.waiting_for_mode)
+
+
+@dp.message(ReportState.waiting_for_mode)
+async def process_report_mode(message: Message, state: FSMContext, currency_client: CurrencyClient):
+    """Обработка выбора вида отчета"""
+    if message.text == "Отмена":
+        await state.clear()
+        await message.answer("❌ Создание отчета отменено", reply_markup=get_main_keyboard())
+        return
+
+    if message.text not in ["📈 Сводка", "📋 Подробно"]:
+        await message.answer("Пожалуйста, выберите вид отчета используя кнопки")
+        return
+
+    await state.update_data(detailed=message.text == "📋 Подробно")
+    # Список валют берется из таблицы курсов, которая затем используется в отчете
     await message.answer(
         "Выберите валюту для отчета:",
-        reply_markup=get_currency_keyboard()
+        reply_markup=get_currency_keyboard(await currency_client.get_currencies())
     )
     await state.set_state(ReportState.waiting_for_currency)
 
 
 @dp.message(ReportState.waiting_for_currency)
-async def process_report_currency(message: Message, state: FSMContext):
+async def process_report_currency(message: Message, state: FSMContext, currency_client: CurrencyClient):
     """Обработка выбора валюты для отчета"""
     if message.text == "Отмена":
         await state.clear()
         await message.answer("❌ Создание отчета отменено", reply_markup=get_main_keyboard())
         return
 
-    if message.text not in ["RUB", "USD", "EUR", "CNY"]:
+    if message.text not in await currency_client.get_currencies():
         await message.answer("Пожалуйста, выберите валюту из предложенных вариантов")
         return
 
     await state.update_data(currency=message.text)
     await message.answer(
         "Выберите период для отчета:",
-        reply_markup=ReplyKeyboardMarkup(
-            keyboard=[
-                [KeyboardButton(text="За сегодня"), KeyboardButton(text="За неделю")],
-                [KeyboardButton(text="За месяц"), KeyboardButton(text="За все время")],
-                [KeyboardButton(text="Отмена")]
-            ],
-            resize_keyboard=True
-        )
+        reply_markup=get_period_keyboard()
     )
     await state.set_state(ReportState.waiting_for_period)
 
 
-@dp.message(ReportState.waiting_for_period)
-async def process_report_period(message: Message, state: FSMContext):
+@dp.message(ReportState.waiting_for_period, flags={'throttle_cost': THROTTLE_COSTS['report']})
+async def process_report_period(message: Message, state: FSMContext, repo: FinanceRepository,
+                                currency_client: CurrencyClient):
     """Генерация и отправка отчета"""
     if message.text == "Отмена":
         await state.clear()
         await message.answer("❌ Создание отчета отменено", reply_markup=get_main_keyboard())
         return
 
-    period_mapping = {
-        "За сегодня": timedelta(days=1),
-        "За неделю": timedelta(weeks=1),
-        "За месяц": timedelta(days=30),
-        "За все время": None
-    }
-
-    if message.text not in period_mapping:
+    if message.text not in PERIODS:
         await message.answer("Пожалуйста, выберите период из предложенных вариантов")
         return
 
     report_data = await state.get_data()
     currency = report_data['currency']
-    conn = None
+    period = PERIODS[message.text]
 
     try:
-        conn = await create_db_connection()
-
-        # Получение курса валюты
-        rate = 1.0
+        # История курса за период запрашивается один раз на отчет,
+        # каждая операция пересчитывается по курсу на свою дату
+        history = RateHistory.constant(1.0)
         if currency != 'RUB':
-            rate = await get_exchange_rate(currency)
-            if rate is None:
+            start = date.today() - period if period is not None else None
+            history = await currency_client.get_history(currency, start)
+            # Сервис курсов недоступен - пересчет по последнему полученному курсу;
+            # в сервис повторно не обращаемся, берем то, что уже есть в кэше
+            rate = currency_client.peek_rate(currency) if history is None else None
+            history_age = currency_client.history_age(currency)
+            if rate is not None:
+                history = RateHistory.constant(rate)
+                await message.answer(
+                    f"⚠️ Сервис курсов недоступен. Отчет по последнему известному курсу "
+                    f"{currency} (получен {format_age(currency_client.rates_age())} назад)."
+                )
+            elif history is not None and currency_client.is_stale(history_age):
+                # Отдана история из кэша, которую еще не удалось обновить
+                await message.answer(
+                    f"⚠️ Курс может быть устаревшим: отчет по истории курса {currency}, "
+                    f"полученной {format_age(history_age)} назад."
+                )
+            elif history is None:
                 await message.answer(
                     "⚠️ Не удалось получить курс валюты. Отчет будет в RUB.",
                     reply_markup=get_main_keyboard()
                 )
                 currency = 'RUB'
-                rate = 1.0
-
-        # Формирование SQL запроса в зависимости от периода
-        if message.text == "За все время":
-            operations = await conn.fetch(
-                "SELECT type_operation, sum, date FROM operations "
-                "WHERE chat_id = $1 ORDER BY date DESC",
-                message.from_user.id
-            )
-        else:
-            operations = await conn.fetch(
-                "SELECT type_operation, sum, date FROM operations "
-                "WHERE chat_id = $1 AND date >= (NOW() - $2::interval) "
-                "ORDER BY date DESC",
-                message.from_user.id,
-                period_mapping[message.text]
+                history = RateHistory.constant(1.0)
+
+        if not report_data.get('detailed'):
+            bucket = SUMMARY_BUCKETS[message.text]
+            if currency == 'RUB':
+                # Сводка считается в БД и не зависит от объема истории
+                summary = await repo.fetch_summary(message.from_user.id, bucket, period)
+            else:
+                # Для пересчета в валюту нужны итоги по дням - их не больше, чем дней в периоде
+                daily = await repo.fetch_daily_totals(message.from_user.id, period)
+                summary = convert_summary(daily, bucket, history.rate_on)
+
+            if not summary:
+                await message.answer(
+                    f"ℹ️ Нет операций за выбранный период ({message.text.lower()})",
+                    reply_markup=get_main_keyboard()
+                )
+                return
+
+            await message.answer(
+                format_summary(summary, message.text.lower()[3:], bucket, currency),
+                reply_markup=get_main_keyboard()
             )
+            return
 
-        if not operations:
+        # Подробный отчет читается страницами и отправляется частями,
+        # поэтому не держит в памяти всю историю операций, а подключение
+        # к БД не занято, пока сообщения ждут отправки
+        has_operations = False
+        async with aclosing(repo.iter_operations(message.from_user.id, period)) as operations:
+            async for chunk in iter_report_chunks(
+                    operations, f"📊 Отчет за {message.text.lower()} ({currency}):\n", currency, history.rate_on
+            ):
+                has_operations = True
+                await message.answer(chunk, reply_markup=get_main_keyboard())
+
+        if not has_operations:
             await message.answer(
                 f"ℹ️ Нет операций за выбранный период ({message.text.lower()})",
                 reply_markup=get_main_keyboard()
             )
-            await state.clear()
-            return
+    except Exception as e:
+        logger.error(f"Ошибка при формировании отчета: {str(e)}")
+        await message.answer(
+            "⚠️ Произошла ошибка при формировании отчета. Пожалуйста, попробуйте позже.",
+            reply_markup=get_main_keyboard()
+        )
+    finally:
+        await state.clear()
 
-        # Формирование отчёта
-        report_lines = [f"📊 Отчет за {message.text.lower()} ({currency}):\n"]
 
-        for op in operations:
-            amount = float(op['sum']) / rate
-            prefix = "⬆️" if op['type_operation'] == 'income' else "⬇️"
+@dp.message(lambda message: message.text == "📤 Экспорт")
+async def export_menu(message: Message, state: FSMContext, user_registered: bool):
+    """Начало выгрузки операций в файл"""
+    if not user_registered:
+        await message.answer("ℹ️ Пожалуйста, сначала зарегистрируйтесь с помощью /register")
+        return
 
-            report_lines.append(
-                f"{prefix} {op['date'].strftime('%d.%m.%Y')} - {amount:.2f} {currency}"
-            )
+    await message.answer(
+        "Выберите формат файла:",
+        reply_markup=get_export_format_keyboard()
+    )
+    await state.set_state(ExportState.waiting_for_format)
+
+
+@dp.message(ExportState.waiting_for_format)
+async def process_export_format(message: Message, state: FSMContext):
+    """Обработка выбора формата выгрузки"""
+    if message.text == "Отмена":
+        await state.clear()
+        await message.answer("❌ Выгрузка отменена", reply_markup=get_main_keyboard())
+        return
+
+    if message.text not in EXPORT_FORMATS:
+        await message.answer("Пожалуйста, выберите формат из предложенных вариантов")
+        return
+
+    await state.update_data(export_format=message.text)
+    await message.answer(
+        "Выберите период для выгрузки:",
+        reply_markup=get_period_keyboard()
+    )
+    await state.set_state(ExportState.waiting_for_period)
+
+
+@dp.message(ExportState.waiting_for_period, flags={'throttle_cost': THROTTLE_COSTS['export']})
+async def process_export_period(message: Message, state: FSMContext, repo: FinanceRepository):
+    """Формирование и отправка файла с операциями"""
+    if message.text == "Отмена":
+        await state.clear()
+        await message.answer("❌ Выгрузка отменена", reply_markup=get_main_keyboard())
+        return
+
+    if message.text not in PERIODS:
+        await message.answer("Пожалуйста, выберите период из предложенных вариантов")
+        return
 
-        await message.answer("\n".join(report_lines), reply_markup=get_main_keyboard())
+    export_data = await state.get_data()
+    compress = EXPORT_FORMATS[export_data['export_format']]
+
+    try:
+        content = await repo.export_operations(message.from_user.id, PERIODS[message.text], compress)
+
+        filename = f"operations_{datetime.now().strftime('%Y%m%d')}.csv" + (".gz" if compress else "")
+        await message.answer_document(
+            BufferedInputFile(content, filename=filename),
+            caption=f"📤 Операции за {message.text.lower()[3:]}",
+            reply_markup=get_main_keyboard()
+        )
     except Exception as e:
-        logger.error(f"Ошибка при формировании отчета: {str(e)}")
+        logger.error(f"Ошибка при выгрузке операций: {str(e)}")
         await message.answer(
-            "⚠️ Произошла ошибка при формировании отчета. Пожалуйста, попробуйте позже.",
+            "⚠️ Произошла ошибка при выгрузке. Пожалуйста, попробуйте позже.",
             reply_markup=get_main_keyboard()
         )
     finally:
-        if conn:
-            await conn.close()
         await state.clear()
 
 
+@dp.message(Command('balance'))
+@dp.message(lambda message: message.text == "💰 Баланс")
+async def show_balance(message: Message, repo: FinanceRepository, user_registered: bool):
+    """Показывает текущий баланс пользователя"""
+    if not user_registered:
+        await message.answer("ℹ️ Пожалуйста, сначала зарегистрируйтесь с помощью /register")
+        return
+
+    try:
+        # Баланс хранится готовым и обновляется вместе с каждой операцией
+        balance = await repo.get_balance(message.from_user.id)
+        if balance is None:
+            await message.answer("ℹ️ У вас пока нет операций", reply_markup=get_main_keyboard())
+            return
+
+        income = float(balance['income'])
+        expense = float(balance['expense'])
+        await message.answer(
+            f"💰 Баланс: {income - expense:.2f} RUB\n\n"
+            f"⬆️ Доходы: {income:.2f} RUB\n"
+            f"⬇️ Расходы: {expense:.2f} RUB\n"
+            f"🧾 Операций: {balance['operations']}",
+            reply_markup=get_main_keyboard()
+        )
+    except Exception as e:
+        logger.error(f"Ошибка при получении баланса: {str(e)}")
+        await message.answer("⚠️ Произошла ошибка. Пожалуйста, попробуйте позже.")
+
+
+@dp.message(Command('digest'))
+async def cmd_digest(message: Message, repo: FinanceRepository, user_registered: bool):
+    """Настройка рассылки сводки за прошедшую неделю или месяц"""
+    if not user_registered:
+        await message.answer("ℹ️ Пожалуйста, сначала зарегистрируйтесь с помощью /register")
+        return
+
+    try:
+        period = await repo.get_digest(message.from_user.id)
+        current = DIGEST_PERIODS[period].lower() if period else "отключена"
+        await message.answer(
+            f"📬 Рассылка сводки: {current}\n\n"
+            "Сводка за прошедшую неделю или месяц приходит в начале следующего периода.",
+            reply_markup=get_digest_keyboard()
+        )
+    except Exception as e:
+        logger.error(f"Ошибка при получении подписки: {str(e)}")
+        await message.answer("⚠️ Произошла ошибка. Пожалуйста, попробуйте позже.")
+
+
+@dp.callback_query(DigestChoice.filter())
+async def choose_digest(callback: CallbackQuery, callback_data: DigestChoice, repo: FinanceRepository,
+                        user_registered: bool):
+    if not user_registered or callback_data.period not in (*DIGEST_PERIODS, "off"):
+        await callback.answer()
+        return
+
+    try:
+        if callback_data.period == "off":
+            await repo.set_digest(callback.from_user.id, None)
+            text = "📭 Рассылка сводки отключена"
+        else:
+            # Первая сводка - за текущий период, когда он закончится
+            start, _ = period_bounds(callback_data.period, date.today())
+            await repo.set_digest(callback.from_user.id, callback_data.period, start)
+            text = f"📬 Рассылка сводки: {DIGEST_PERIODS[callback_data.period].lower()}"
+        await callback.message.edit_text(text)
+        await callback.answer()
+    except Exception as e:
+        logger.error(f"Ошибка при изменении подписки: {str(e)}")
+        await callback.answer("⚠️ Произошла ошибка. Пожалуйста, попробуйте позже.")
+
+
 @dp.message(lambda message: message.text == "ℹ️ Помощь")
 async def show_help(message: Message):
     """Показывает справку по боту"""
@@ -636,15 +1034,20 @@ async def show_help(message: Message):
         "Основные команды:\n"
         "/start - Запустить бота\n"
         "/register - Регистрация\n"
+        "/balance - Текущий баланс\n"
+        "/digest - Рассылка сводки за неделю или месяц\n"
         "/update_operation - Изменить операцию\n\n"
         "Основные функции:\n"
         "➕ Добавить операцию - Внести новую операцию (доход/расход)\n"
-        "📊 Отчеты - Просмотр статистики за период\n\n"
+        "📊 Отчеты - Просмотр статистики за период\n"
+        "📤 Экспорт - Выгрузка операций в CSV-файл\n\n"
         "Для добавления операции укажите:\n"
         "1. Тип (доход/расход)\n"
         "2. Сумму\n"
         "3. Дату\n\n"
-        "Отчеты можно получить в разных валютах."
+        "Отчеты можно получить в разных валютах.\n\n"
+        "Для импорта отправьте CSV-файл с колонками date,type_operation,sum "
+        "(например, ранее выгруженный через 📤 Экспорт)."
     )
     await message.answer(help_text, parse_mode='HTML')
 
@@ -658,10 +1061,105 @@ async def handle_unknown_message(message: Message):
     )
 
 
+def create_webhook_app() -> web.Application:
+    """Создает aiohttp-приложение, принимающее обновления от Telegram.
+
+    Запросы без верного X-Telegram-Bot-Api-Secret-Token отклоняются.
+    """
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=WEBHOOK_CONFIG['secret']
+    ).register(app, path=WEBHOOK_CONFIG['path'])
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+async def run_webhook():
+    """Запуск бота в режиме webhook"""
+    runner = web.AppRunner(create_webhook_app())
+    await runner.setup()
+    try:
+        site = web.TCPSite(
+            runner,
+            WEBHOOK_CONFIG['host'],
+            WEBHOOK_CONFIG['port'],
+            reuse_port=WEBHOOK_CONFIG['reuse_port'] or None
+        )
+        await site.start()
+        if WEBHOOK_CONFIG['url']:
+            await bot.set_webhook(
+                WEBHOOK_CONFIG['url'] + WEBHOOK_CONFIG['path'],
+                secret_token=WEBHOOK_CONFIG['secret'],
+                allowed_updates=dp.resolve_used_update_types()
+            )
+        logger.info(f"Webhook слушает {WEBHOOK_CONFIG['host']}:{WEBHOOK_CONFIG['port']}{WEBHOOK_CONFIG['path']}")
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+async def reconcile_balances(repo: FinanceRepository):
+    """Периодически сверяет сохраненные балансы с операциями"""
+    while True:
+        await asyncio.sleep(BALANCE_RECONCILE_INTERVAL)
+        try:
+            fixed = await repo.reconcile_balances()
+            if fixed:
+                logger.warning(f"Исправлены расхождения баланса у {len(fixed)} пользователей: {fixed[:20]}")
+        except Exception as e:
+            logger.error(f"Ошибка при сверке балансов: {str(e)}")
+
+
 async def main():
     """Основная функция запуска бота"""
-    await init_db()
-    await dp.start_polling(bot)
+    if BOT_MODE == 'webhook' and not WEBHOOK_CONFIG['secret']:
+        logger.error("Для BOT_MODE=webhook нужен WEBHOOK_SECRET: "
+                     "без него webhook примет запросы не только от Telegram")
+        exit(1)
+    db_pool = await create_db_pool()
+    repo = create_repository(db_pool)
+    currency_client = CurrencyClient(CURRENCY_SERVICE_URL, **CURRENCY_CLIENT_CONFIG)
+    operation_writer = None
+    if WRITE_BEHIND:
+        operation_writer = OperationWriter(repo, **WRITE_BEHIND_CONFIG)
+    metrics_runner = None
+    reconcile_task = None
+    digest_scheduler = None
+    if DIGEST_CONFIG['interval']:
+        digest_scheduler = DigestScheduler(bot, repo, **DIGEST_CONFIG)
+    try:
+        await init_db(db_pool)
+        if operation_writer is not None:
+            operation_writer.start()
+        if METRICS_PORT:
+            register_runtime_metrics(db_pool, operation_writer, storage, outbound, currency_client,
+                                     digest_scheduler)
+            metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT)
+        if BALANCE_RECONCILE_INTERVAL:
+            reconcile_task = asyncio.create_task(reconcile_balances(repo))
+        if digest_scheduler is not None:
+            digest_scheduler.start()
+        # Репозиторий, клиент курсов и очередь записи передаются в обработчики как аргументы
+        dp["repo"] = repo
+        dp["currency_client"] = currency_client
+        dp["operation_writer"] = operation_writer
+        if BOT_MODE == 'webhook':
+            await run_webhook()
+        else:
+            await dp.start_polling(bot)
+    finally:
+        if reconcile_task is not None:
+            reconcile_task.cancel()
+        if digest_scheduler is not None:
+            await digest_scheduler.close()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        if operation_writer is not None:
+            await operation_writer.close()
+        await currency_client.close()
+        await db_pool.close()
 
 
 if __name__ == '__main__':
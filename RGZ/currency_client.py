@@ -0,0 +1,363 @@
+import time
+import asyncio
+import logging
+from bisect import bisect_right
+from datetime import date
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import aiohttp
+
+from metrics import CURRENCY_CIRCUIT_REJECTED, CURRENCY_REQUEST_ERRORS, CURRENCY_REQUEST_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class RateHistory:
+    """Курс валюты во времени: даты начала действия по возрастанию и курсы.
+
+    rate_on находит курс на дату двоичным поиском; подряд идущие
+    операции обычно относятся к одной дате, поэтому последний ответ запоминается.
+    """
+
+    def __init__(self, points: Sequence[Tuple[date, float]]):
+        self.dates = [day for day, _ in points]
+        self.rates = [rate for _, rate in points]
+        self._last_date = None
+        self._last_rate = None
+
+    @classmethod
+    def constant(cls, rate: float) -> 'RateHistory':
+        return cls([(date.min, rate)])
+
+    def rate_on(self, day: date) -> float:
+        """Курс, действовавший на дату day (для более ранних дат - самый первый)"""
+        if day != self._last_date:
+            index = bisect_right(self.dates, day) - 1
+            self._last_date, self._last_rate = day, self.rates[max(index, 0)]
+        return self._last_rate
+
+
+class CachedHistory:
+    """История курса одной валюты в кэше клиента: точки, полные начиная с даты start.
+
+    Прошлые точки истории не меняются, поэтому при обновлении
+    запрашивается только хвост - начиная с последней известной точки.
+    version - версия таблицы курсов, с которой получены точки.
+    """
+
+    def __init__(self, start: date, points: List[Tuple[date, float]], version: Optional[int] = None):
+        self.start = start
+        self.points = points
+        self.version = version
+        self.history = RateHistory(points)
+        self.fetched_at = time.monotonic()
+
+    def merge(self, start: date, points: List[Tuple[date, float]],
+              version: Optional[int] = None) -> 'CachedHistory':
+        """Новая запись: точки points (полные с даты start) поверх уже известных"""
+        if not points:
+            return self
+        older = [point for point in self.points if point[0] < points[0][0]]
+        return CachedHistory(min(start, self.start), older + points, version)
+
+    def outdated(self, version: Optional[int]) -> bool:
+        """Курсы в сервисе изменились после получения истории (по версии таблицы)"""
+        return version is not None and self.version is not None and self.version < version
+
+
+class CircuitBreaker:
+    """Размыкатель цепи для запросов к сервису.
+
+    После failure_threshold неудачных запросов подряд цепь размыкается
+    (open): запросы не выполняются, и вызывающий сразу получает отказ.
+    Через reset_timeout секунд пропускается один пробный запрос (half_open):
+    при успехе цепь замыкается, при неудаче снова ждет reset_timeout.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 3, reset_timeout: float = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+
+    def allow(self) -> bool:
+        """Можно ли выполнить запрос сейчас"""
+        if self.state == self.CLOSED:
+            return True
+        # Если пробный запрос потерялся (например, отменен), через
+        # reset_timeout пропускается следующий
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            self.state = self.HALF_OPEN
+            self._opened_at = time.monotonic()
+            return True
+        return False
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            logger.info("Сервис курсов снова доступен")
+        self.state = self.CLOSED
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state == self.CLOSED:
+                logger.warning(f"Сервис курсов недоступен ({self.failures} ошибок подряд), "
+                               f"запросы приостановлены на {self.reset_timeout} с")
+            self.state = self.OPEN
+            self._opened_at = time.monotonic()
+
+
+class CurrencyClient:
+    """Клиент микросервиса курсов валют.
+
+    Держит одну долгоживущую HTTP-сессию с пулом keep-alive соединений
+    и кэширует всю таблицу курсов, полученную одним запросом /rates:
+    - пока таблица моложе ttl, курсы отдаются из кэша;
+    - еще stale_ttl секунд отдается устаревшая таблица, а обновление идет в фоне;
+    - одновременные запросы сводятся к одному запросу в сервис.
+    Так же, с теми же ttl и stale_ttl, кэшируется история курса каждой
+    валюты; при обновлении запрашивается только ее хвост. Если таблица
+    пришла с новой версией курсов, история обновляется, не дожидаясь ttl.
+    Пока сервис недоступен (цепь разомкнута), запросы в него не идут,
+    а отдаются последние полученные таблица и история - их возраст дают
+    rates_age и history_age, а is_stale говорит, пора ли предупредить о нем.
+    Пробный запрос при этом идет в фоне, если в кэше есть что отдать.
+    Неудачный запрос таблицы или истории запоминается на negative_ttl секунд:
+    все это время отдается то, что есть в кэше (или None), без нового ожидания ответа.
+    """
+
+    BASE_CURRENCY = 'RUB'
+
+    def __init__(self, base_url: str, ttl: float = 600, stale_ttl: float = 3600,
+                 timeout: float = 3, pool_size: int = 100, failure_threshold: int = 3,
+                 reset_timeout: float = 30, negative_ttl: float = 30):
+        self.base_url = base_url
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.negative_ttl = negative_ttl
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.pool_size = pool_size
+        self.version: Optional[int] = None
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._rates: Optional[Dict[str, float]] = None
+        self._fetched_at = 0.0
+        self._failed_at: Optional[float] = None
+        self._inflight: Optional[asyncio.Task] = None
+        self._history: Dict[str, CachedHistory] = {}
+        self._history_inflight: Dict[str, asyncio.Task] = {}
+        self._history_failed_at: Dict[str, float] = {}
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60),
+                timeout=self.timeout
+            )
+        return self._session
+
+    async def close(self):
+        """Закрывает HTTP-сессию и дожидается фонового обновления"""
+        pending = list(self._history_inflight.values())
+        if self._inflight is not None:
+            pending.append(self._inflight)
+        await asyncio.gather(*pending, return_exceptions=True)
+        if self._session is not None:
+            await self._session.close()
+
+    async def get_rates(self) -> Optional[Dict[str, float]]:
+        """Таблица курсов {валюта: курс к RUB}, включая сам RUB.
+        None, если сервис недоступен и в кэше ничего нет"""
+        if self._rates is not None:
+            age = time.monotonic() - self._fetched_at
+            if age < self.ttl:
+                return self._rates
+            if age < self.ttl + self.stale_ttl or not self._service_available():
+                # Отдаем устаревшую таблицу, а свежую запрашиваем в фоне
+                if not self._recently_failed(self._failed_at):
+                    self._refresh()
+                return self._rates
+        if self._recently_failed(self._failed_at):
+            # Сервис только что не ответил - не ждем нового таймаута
+            return self._rates
+
+        return await asyncio.shield(self._refresh())
+
+    def rates_age(self) -> Optional[float]:
+        """Сколько секунд назад получена таблица курсов (None - еще не получена)"""
+        if self._rates is None:
+            return None
+        return time.monotonic() - self._fetched_at
+
+    def history_age(self, currency: str) -> Optional[float]:
+        """Сколько секунд назад обновлена история курса (None - еще не получена)"""
+        cached = self._history.get(currency)
+        if cached is None:
+            return None
+        return time.monotonic() - cached.fetched_at
+
+    def is_stale(self, age: Optional[float]) -> bool:
+        """Стоит ли предупредить, что данные такого возраста могут быть устаревшими:
+        они старше ttl или сервис сейчас недоступен"""
+        return age is not None and (age >= self.ttl or not self._service_available())
+
+    async def get_currencies(self) -> List[str]:
+        """Доступные валюты, базовая первой"""
+        rates = await self.get_rates()
+        if rates is None:
+            return [self.BASE_CURRENCY]
+        return [self.BASE_CURRENCY] + sorted(c for c in rates if c != self.BASE_CURRENCY)
+
+    def peek_rate(self, currency: str) -> Optional[float]:
+        """Курс из уже полученной таблицы, без запроса к сервису"""
+        if currency == self.BASE_CURRENCY:
+            return 1.0
+        return self._rates.get(currency) if self._rates is not None else None
+
+    async def get_history(self, currency: str, start: Optional[date] = None) -> Optional[RateHistory]:
+        """История курса валюты начиная с даты start (без start - вся).
+        None, если сервис недоступен и в кэше ничего нет"""
+        if currency == self.BASE_CURRENCY:
+            return RateHistory.constant(1.0)
+        start = start or date.min
+
+        while True:
+            cached = self._history.get(currency)
+            failed = self._recently_failed(self._history_failed_at.get(currency))
+            if cached is not None and cached.start <= start:
+                age = time.monotonic() - cached.fetched_at
+                outdated = cached.outdated(self.version)
+                if age < self.ttl and not outdated:
+                    return cached.history
+                if failed:
+                    return cached.history
+                # Прошлое уже известно, дозапрашивается только хвост;
+                # после смены курсов в сервисе старую историю не отдаем
+                task = self._refresh_history(currency, cached.points[-1][0])
+                if (age < self.ttl + self.stale_ttl and not outdated) or not self._service_available():
+                    return cached.history
+                return await asyncio.shield(task)
+
+            task = self._history_inflight.get(currency)
+            if task is None:
+                if failed:
+                    # Сервис только что не ответил - не ждем нового таймаута
+                    return cached.history if cached is not None else None
+                return await asyncio.shield(self._refresh_history(currency, start))
+            # Уже идет запрос этой валюты - возможно, он покроет и нужный период
+            await asyncio.shield(task)
+
+    def _service_available(self) -> bool:
+        return self.breaker.state == CircuitBreaker.CLOSED
+
+    def _recently_failed(self, failed_at: Optional[float]) -> bool:
+        return failed_at is not None and time.monotonic() - failed_at < self.negative_ttl
+
+    def _refresh(self) -> asyncio.Task:
+        """Запускает запрос таблицы курсов, если он еще не выполняется"""
+        if self._inflight is None:
+            self._inflight = asyncio.create_task(self._fetch())
+            self._inflight.add_done_callback(self._fetch_done)
+        return self._inflight
+
+    def _fetch_done(self, _):
+        self._inflight = None
+
+    async def _fetch(self) -> Optional[Dict[str, float]]:
+        # При ошибке или разомкнутой цепи остается последняя полученная таблица
+        if not self.breaker.allow():
+            CURRENCY_CIRCUIT_REJECTED.inc()
+            return self._rates
+        with CURRENCY_REQUEST_SECONDS.time():
+            rates = await self._request()
+        if rates is None:
+            CURRENCY_REQUEST_ERRORS.inc()
+            self.breaker.record_failure()
+            self._failed_at = time.monotonic()
+            return self._rates
+        self.breaker.record_success()
+        self._failed_at = None
+        return rates
+
+    def _refresh_history(self, currency: str, start: date) -> asyncio.Task:
+        """Запускает запрос истории валюты, если он еще не выполняется"""
+        task = self._history_inflight.get(currency)
+        if task is None:
+            task = self._history_inflight[currency] = asyncio.create_task(
+                self._fetch_history(currency, start)
+            )
+            task.add_done_callback(lambda _: self._history_inflight.pop(currency, None))
+        return task
+
+    async def _fetch_history(self, currency: str, start: date) -> Optional[RateHistory]:
+        # При ошибке или разомкнутой цепи остается последняя полученная история
+        cached = self._history.get(currency)
+        stale = cached.history if cached is not None else None
+        if not self.breaker.allow():
+            CURRENCY_CIRCUIT_REJECTED.inc()
+            return stale
+
+        params = {'currency': currency}
+        if start != date.min:
+            params['from'] = start.isoformat()
+        with CURRENCY_REQUEST_SECONDS.time():
+            response = await self._request_history(params)
+        if response is None:
+            CURRENCY_REQUEST_ERRORS.inc()
+            self.breaker.record_failure()
+            self._history_failed_at[currency] = time.monotonic()
+            return stale
+        self.breaker.record_success()
+        self._history_failed_at.pop(currency, None)
+
+        points, version = response
+        cached = self._history.get(currency)
+        if cached is not None:
+            cached = cached.merge(start, points, version)
+        else:
+            cached = CachedHistory(start, points, version)
+        self._history[currency] = cached
+        return cached.history
+
+    async def _request(self) -> Optional[Dict[str, float]]:
+        try:
+            async with self._get_session().get(f"{self.base_url}/rates") as response:
+                if response.status == 200:
+                    data = await response.json()
+                    rates = {currency: float(rate) for currency, rate in data['rates'].items()}
+                    rates[data.get('base', self.BASE_CURRENCY)] = 1.0
+                    self._rates = rates
+                    self._fetched_at = time.monotonic()
+                    self.version = data.get('version')
+                    return rates
+
+                logger.warning(f"Не удалось получить курсы валют. Код ответа: {response.status}")
+                return None
+
+        except Exception as e:
+            logger.error(f"Ошибка при получении курсов валют: {str(e)}")
+            return None
+
+    async def _request_history(
+            self, params: Dict[str, str]
+    ) -> Optional[Tuple[List[Tuple[date, float]], Optional[int]]]:
+        """Точки истории и версия таблицы курсов, на которой она построена"""
+        try:
+            async with self._get_session().get(f"{self.base_url}/history", params=params) as response:
+                if response.status == 200:
+                    data = await response.json()
+                    points = [(date.fromisoformat(day), float(rate)) for day, rate in data['history']]
+                    return points, data.get('version')
+
+                logger.warning(f"Не удалось получить историю курса. Код ответа: {response.status}")
+                return None
+
+        except Exception as e:
+            logger.error(f"Ошибка при получении истории курса: {str(e)}")
+            return None
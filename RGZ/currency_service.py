@@ -1,25 +1,46 @@
+import os
+import sys
 from flask import Flask, request, jsonify
 import logging
-from datetime import datetime
+from bisect import bisect_right
+from datetime import date, datetime
+
+# Общие модули лежат в каталоге common в корне репозитория
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.logging_setup import SAMPLED, setup_logging
 
 app = Flask(__name__)
 
 # Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('currency_service.log'),
-        logging.StreamHandler()
-    ]
-)
+setup_logging('currency_service.log')
 logger = logging.getLogger(__name__)
 
+# Курсы к базовой валюте
+BASE_CURRENCY = 'RUB'
 CURRENCY_RATES = {
     'USD': 90.5,
     'EUR': 98.7,
     'CNY': 12.3
 }
+# Версия таблицы курсов увеличивается при каждом ее изменении
+RATES_VERSION = 1
+RATES_UPDATED_AT = datetime.now()
+
+# Прошлые значения курсов: (дата, с которой действует курс, курс)
+HISTORICAL_RATES = {
+    'USD': [(date(2024, 1, 1), 89.69), (date(2024, 7, 1), 85.75), (date(2025, 1, 1), 101.68),
+            (date(2025, 7, 1), 78.52)],
+    'EUR': [(date(2024, 1, 1), 99.19), (date(2024, 7, 1), 92.42), (date(2025, 1, 1), 106.10),
+            (date(2025, 7, 1), 92.12)],
+    'CNY': [(date(2024, 1, 1), 12.60), (date(2024, 7, 1), 11.74), (date(2025, 1, 1), 13.43),
+            (date(2025, 7, 1), 10.95)],
+}
+# История по валютам в порядке дат, последняя точка - текущий курс.
+# Даты и курсы хранятся отдельными списками для поиска через bisect
+RATE_HISTORY = {}
+for _currency, _rate in CURRENCY_RATES.items():
+    _points = sorted(HISTORICAL_RATES.get(_currency, []) + [(RATES_UPDATED_AT.date(), _rate)])
+    RATE_HISTORY[_currency] = ([d for d, _ in _points], [r for _, r in _points])
 
 
 @app.route('/rate', methods=['GET'])
@@ -37,7 +58,7 @@ def get_exchange_rate():
 
     try:
         rate = CURRENCY_RATES[currency]
-        logger.info(f"Успешно возвращен курс {currency}: {rate}")
+        logger.info(f"Успешно возвращен курс {currency}: {rate}", extra=SAMPLED)
         return jsonify({
             "currency": currency,
             "rate": rate,
@@ -48,5 +69,59 @@ def get_exchange_rate():
         return jsonify({"message": "UNEXPECTED ERROR"}), 500
 
 
+@app.route('/rates', methods=['GET'])
+def get_exchange_rates():
+    """Курсы всех валют (или перечисленных через запятую в currencies) одним ответом"""
+    requested = [c.strip().upper() for c in request.args.get('currencies', '').split(',') if c.strip()]
+
+    unknown = [c for c in requested if c not in CURRENCY_RATES]
+    if unknown:
+        logger.warning(f"Запрошены неизвестные курсы: {', '.join(unknown)}")
+        return jsonify({"message": "UNKNOWN CURRENCY", "unknown": unknown}), 400
+
+    rates = {c: CURRENCY_RATES[c] for c in requested} if requested else CURRENCY_RATES
+    logger.info(f"Успешно возвращено курсов: {len(rates)}", extra=SAMPLED)
+    return jsonify({
+        "base": BASE_CURRENCY,
+        "rates": rates,
+        "version": RATES_VERSION,
+        "timestamp": RATES_UPDATED_AT.isoformat()
+    }), 200
+
+
+@app.route('/history', methods=['GET'])
+def get_rate_history():
+    """История курса валюты за период from..to (даты в формате ГГГГ-ММ-ДД).
+
+    Первой в ответе идет последняя точка до начала периода,
+    чтобы курс был известен на любую дату периода.
+    """
+    currency = request.args.get('currency', '').upper()
+    if not currency:
+        logger.warning("Запрос истории без параметра currency")
+        return jsonify({"message": "Currency parameter is required"}), 400
+
+    if currency not in RATE_HISTORY:
+        logger.warning(f"Запрошена история неизвестного курса: {currency}")
+        return jsonify({"message": "UNKNOWN CURRENCY"}), 400
+
+    try:
+        start = date.fromisoformat(request.args['from']) if request.args.get('from') else date.min
+        end = date.fromisoformat(request.args['to']) if request.args.get('to') else date.max
+    except ValueError:
+        return jsonify({"message": "Dates must be in YYYY-MM-DD format"}), 400
+
+    dates, rates = RATE_HISTORY[currency]
+    first = max(bisect_right(dates, start) - 1, 0)
+    last = max(bisect_right(dates, end), first + 1)
+    logger.info(f"Успешно возвращена история {currency}: {last - first} точек", extra=SAMPLED)
+    return jsonify({
+        "base": BASE_CURRENCY,
+        "currency": currency,
+        "history": [[dates[i].isoformat(), rates[i]] for i in range(first, last)],
+        "version": RATES_VERSION
+    }), 200
+
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
@@ -0,0 +1,109 @@
+import asyncio
+import logging
+from datetime import date, datetime, timedelta
+from typing import Optional, Tuple
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramForbiddenError
+
+from outbound import bulk_priority
+from reports import format_summary
+from repository import FinanceRepository
+
+logger = logging.getLogger(__name__)
+
+DIGEST_PERIODS = {
+    "week": "Еженедельно",
+    "month": "Ежемесячно",
+}
+
+
+def period_bounds(period: str, today: date) -> Tuple[date, date]:
+    """Начало текущего и предыдущего периода (неделя - с понедельника)"""
+    if period == "week":
+        start = today - timedelta(days=today.weekday())
+        return start, start - timedelta(weeks=1)
+    start = today.replace(day=1)
+    return start, (start - timedelta(days=1)).replace(day=1)
+
+
+def format_digest(row, period: str, previous_start: date, start: date) -> str:
+    last_day = start - timedelta(days=1)
+    title = (f"{'прошлую неделю' if period == 'week' else 'прошлый месяц'}, "
+             f"{previous_start.strftime('%d.%m')} - {last_day.strftime('%d.%m.%Y')}")
+    return format_summary([row], title, "day", "RUB")
+
+
+class DigestScheduler:
+    """Рассылка еженедельных и ежемесячных дайджестов.
+
+    Раз в interval секунд (но не раньше send_hour часов) проверяет,
+    начался ли новый период. Итоги всех подписчиков считаются одним
+    запросом, а сообщения отправляются с низким приоритетом, чтобы не
+    задерживать ответы пользователям. Темп отправки и повторы после 429
+    обеспечивает очередь исходящих сообщений сессии бота (OutboundQueue).
+    """
+
+    def __init__(self, bot: Bot, repo: FinanceRepository, interval: float = 3600,
+                 send_hour: int = 9):
+        self.bot = bot
+        self.repo = repo
+        self.interval = interval
+        self.send_hour = send_hour
+        self._task: Optional[asyncio.Task] = None
+        # Метрики
+        self.sent_total = 0
+        self.failed_total = 0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            if datetime.now().hour >= self.send_hour:
+                for period in DIGEST_PERIODS:
+                    try:
+                        await self.send_digests(period, date.today())
+                    except Exception as e:
+                        logger.error(f"Ошибка при рассылке дайджестов ({period}): {str(e)}")
+            await asyncio.sleep(self.interval)
+
+    async def send_digests(self, period: str, today: date) -> int:
+        """Отправляет дайджесты за прошедший период. Возвращает число отправленных"""
+        start, previous_start = period_bounds(period, today)
+        rows = await self.repo.claim_digests(period, start, previous_start)
+        sent = 0
+        for row in rows:
+            # Без операций за период дайджест не отправляется
+            if row['operations'] == 0:
+                continue
+            if await self._send(row['chat_id'], format_digest(row, period, previous_start, start)):
+                sent += 1
+        if rows:
+            logger.info(f"Дайджесты ({period}): отправлено {sent} из {len(rows)}")
+        return sent
+
+    async def _send(self, chat_id: int, text: str) -> bool:
+        try:
+            with bulk_priority():
+                await self.bot.send_message(chat_id, text)
+            self.sent_total += 1
+            return True
+        except TelegramForbiddenError:
+            # Пользователь заблокировал бота - подписка больше не нужна
+            await self.repo.set_digest(chat_id, None)
+        except Exception as e:
+            logger.error(f"Ошибка при отправке дайджеста {chat_id}: {str(e)}")
+        self.failed_total += 1
+        return False
@@ -0,0 +1,133 @@
+import io
+import csv
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from typing import BinaryIO, Iterable, List, Tuple
+
+from repository import FinanceRepository
+
+# Тип операции в файле: как в выгрузке или как на кнопках бота
+OPERATION_TYPES = {
+    'income': 'income',
+    'expense': 'expense',
+    'доход': 'income',
+    'расход': 'expense'
+}
+DATE_FORMATS = ("%Y-%m-%d", "%d.%m.%Y")
+
+
+class ImportTooLargeError(ValueError):
+    """Распакованный файл больше допустимого размера"""
+
+
+class LimitedReader(io.RawIOBase):
+    """Обертка потока, которая прерывает чтение после limit байт.
+
+    Ограничивает и файл из одной огромной строки, которую лимит
+    на число строк не останавливает.
+    """
+
+    def __init__(self, raw: BinaryIO, limit: int):
+        self.raw = raw
+        self.limit = limit
+        self.total = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        data = self.raw.read(min(len(buffer), self.limit - self.total + 1))
+        self.total += len(data)
+        if self.total > self.limit:
+            raise ImportTooLargeError(f"файл больше {self.limit} байт")
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def parse_date(value: str):
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format).date()
+        except ValueError:
+            pass
+    raise ValueError(f"неверная дата '{value}'")
+
+
+def parse_operations_csv(lines: Iterable[str], max_rows: int,
+                         max_errors: int) -> Tuple[List[tuple], List[str], int]:
+    """Построчно разбирает CSV с колонками date,type_operation,sum.
+
+    Возвращает корректные строки в виде (date, type_operation, sum),
+    первые max_errors ошибок с номерами строк файла и общее число ошибок.
+    В лимит max_rows входят все строки с данными, в том числе ошибочные,
+    поэтому разбор большого файла из одних ошибок тоже прерывается.
+    """
+    records, errors = [], []
+    error_count = 0
+    data_rows = 0
+    reader = csv.reader(lines, delimiter=',')
+
+    def add_error(text: str):
+        nonlocal error_count
+        error_count += 1
+        if len(errors) < max_errors:
+            errors.append(text)
+
+    for row in reader:
+        line_no = reader.line_num
+        if not row or not any(cell.strip() for cell in row):
+            continue
+        # Строка заголовка, например из выгрузки
+        if line_no == 1 and row[0].strip().lower() == 'date':
+            continue
+
+        data_rows += 1
+        if data_rows > max_rows:
+            # Остаток файла не читается - об этом сообщается всегда
+            errors.append(f"строка {line_no}: превышен лимит в {max_rows} строк, остальные не прочитаны")
+            error_count += 1
+            break
+
+        if len(row) != 3:
+            add_error(f"строка {line_no}: ожидается 3 колонки, получено {len(row)}")
+            continue
+
+        date_value, type_value, sum_value = (cell.strip() for cell in row)
+        try:
+            operation_date = parse_date(date_value)
+
+            type_operation = OPERATION_TYPES.get(type_value.lower())
+            if type_operation is None:
+                raise ValueError(f"неизвестный тип операции '{type_value}'")
+
+            try:
+                amount = Decimal(sum_value.replace(',', '.'))
+            except InvalidOperation:
+                raise ValueError(f"неверная сумма '{sum_value}'")
+            if not amount.is_finite() or amount <= 0:
+                raise ValueError("сумма должна быть больше нуля")
+        except ValueError as e:
+            add_error(f"строка {line_no}: {str(e)}")
+            continue
+
+        records.append((operation_date, type_operation, amount))
+
+    return records, errors, error_count
+
+
+def parse_operations_file(raw: BinaryIO, max_rows: int, max_errors: int,
+                          max_bytes: int) -> Tuple[List[tuple], List[str], int]:
+    """Разбирает файл CSV в UTF-8 (можно с BOM), читая его построчно.
+    Больше max_bytes байт (после распаковки) не читается - ImportTooLargeError.
+    Синхронная функция - в боте вызывается через asyncio.to_thread"""
+    stream = io.BufferedReader(LimitedReader(raw, max_bytes))
+    with io.TextIOWrapper(stream, encoding='utf-8-sig', newline='') as lines:
+        return parse_operations_csv(lines, max_rows, max_errors)
+
+
+async def import_operations(repo: FinanceRepository, chat_id: int, records: List[tuple]):
+    """Загружает операции через COPY и обновляет дневные итоги в одной транзакции"""
+    await repo.save_operations([
+        (chat_id, type_operation, amount, operation_date)
+        for operation_date, type_operation, amount in records
+    ])
@@ -0,0 +1,286 @@
+"""Нагрузочный тест бота без Telegram.
+
+Синтетические обновления подаются в dp.feed_update, ответы бота
+перехватывает сессия-заглушка. Бот работает с настоящей базой
+(настройки DB_* из .env, с DB_BACKEND=sqlite - без сервера БД) и сервисом
+курсов валют: если CURRENCY_SERVICE_URL не задан, currency_service
+запускается в этом же процессе.
+
+Пример: python load_test.py --users 200 --operations 5 --reports 2
+С --outbound ответы идут через очередь исходящих сообщений бота
+(лимиты OUTBOUND_* из окружения), а --flood N отвечает 429 на каждую
+N-ю отправку, чтобы проверить повторы после retry_after.
+"""
+import os
+import sys
+import time
+import json
+import asyncio
+import logging
+import argparse
+import datetime
+import itertools
+import threading
+from collections import defaultdict
+from typing import Dict, List
+
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.types import Chat, Message, Update, User
+
+# Токен не проверяется Telegram, но нужен для создания бота при импорте
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '1:load-test')
+# Синтетические пользователи шлют обновления без пауз, ограничение частоты
+# запросов измеряется отдельно (--throttle оставляет настройки из окружения)
+if '--throttle' not in sys.argv:
+    os.environ['THROTTLE_RATE'] = os.environ['THROTTLE_BURST'] = '1000000000'
+import bot_RGZ_IM as finance_bot
+
+logger = logging.getLogger("load_test")
+
+# Идентификаторы синтетических пользователей, чтобы не задеть настоящих
+CHAT_ID_BASE = 9_000_000_000_000
+
+
+class StubSession(BaseSession):
+    """Сессия бота, которая вместо обращения к Telegram сразу возвращает ответ"""
+
+    def __init__(self, latency: float = 0.0, flood_every: int = 0, retry_after: int = 1):
+        super().__init__()
+        self.latency = latency
+        self.flood_every = flood_every
+        self.retry_after = retry_after
+        self.requests = 0
+        # Обработчики перехватывают исключения и отвечают сообщением об ошибке
+        self.error_replies = 0
+        self.throttled_replies = 0
+        self.retry_after_replies = 0
+        self._message_ids = itertools.count(1)
+
+    async def make_request(self, bot, method, timeout=None):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.flood_every and self.requests % self.flood_every == 0:
+            self.retry_after_replies += 1
+            raise TelegramRetryAfter(method=method, message="Too Many Requests",
+                                     retry_after=self.retry_after)
+        text = getattr(method, 'text', None) or ''
+        if text.startswith('⚠️'):
+            self.error_replies += 1
+        elif text.startswith('⏳'):
+            self.throttled_replies += 1
+        chat_id = getattr(method, 'chat_id', None)
+        if chat_id is not None and 'Message' in str(method.__returning__):
+            return Message(
+                message_id=next(self._message_ids),
+                date=datetime.datetime.now(),
+                chat=Chat(id=chat_id, type='private')
+            )
+        return True
+
+    async def stream_content(self, *args, **kwargs):
+        yield b''
+
+    async def close(self):
+        pass
+
+
+_update_ids = itertools.count(1)
+
+
+def make_update(chat_id: int, text: str) -> Update:
+    update_id = next(_update_ids)
+    return Update(
+        update_id=update_id,
+        message=Message(
+            message_id=update_id,
+            date=datetime.datetime.now(),
+            chat=Chat(id=chat_id, type='private'),
+            from_user=User(id=chat_id, is_bot=False, first_name='load'),
+            text=text
+        )
+    )
+
+
+def percentile(values: List[float], p: float) -> float:
+    """Перцентиль по методу ближайшего ранга (values отсортированы)"""
+    if not values:
+        return 0.0
+    index = max(0, min(len(values) - 1, int(round(p / 100 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+class LoadTest:
+    def __init__(self, bot: Bot, users: int, operations: int, reports: int):
+        self.bot = bot
+        self.users = users
+        self.operations = operations
+        self.reports = reports
+        self.timings: Dict[str, List[float]] = defaultdict(list)
+        self.updates = 0
+        self.errors = 0
+
+    async def _flow(self, name: str, chat_id: int, texts: List[str]):
+        started = time.perf_counter()
+        for text in texts:
+            try:
+                await finance_bot.dp.feed_update(self.bot, make_update(chat_id, text))
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"Ошибка в сценарии {name}: {str(e)}")
+            self.updates += 1
+        self.timings[name].append(time.perf_counter() - started)
+
+    async def _user(self, number: int):
+        chat_id = CHAT_ID_BASE + number
+        await self._flow("register", chat_id, ["/start", "/register", f"Нагрузка {number}"])
+        for i in range(self.operations):
+            await self._flow("add_operation", chat_id, [
+                "➕ Добавить операцию", "Доход" if i % 2 == 0 else "Расход", f"{100 + i}.50", "Сегодня"
+            ])
+        for i in range(self.reports):
+            await self._flow("report_summary", chat_id, ["📊 Отчеты", "📈 Сводка", "USD", "За месяц"])
+            await self._flow("report_detailed", chat_id, ["📊 Отчеты", "📋 Подробно", "EUR", "За все время"])
+
+    async def run(self) -> float:
+        started = time.perf_counter()
+        await asyncio.gather(*(self._user(number) for number in range(self.users)))
+        return time.perf_counter() - started
+
+    def results(self, elapsed: float) -> dict:
+        flows = {}
+        for name, values in self.timings.items():
+            values = sorted(values)
+            flows[name] = {
+                'count': len(values),
+                'p50_ms': round(percentile(values, 50) * 1000, 2),
+                'p95_ms': round(percentile(values, 95) * 1000, 2),
+                'p99_ms': round(percentile(values, 99) * 1000, 2),
+            }
+        return {
+            'users': self.users,
+            'updates': self.updates,
+            'errors': self.errors,
+            'elapsed_s': round(elapsed, 3),
+            'updates_per_s': round(self.updates / elapsed, 1) if elapsed else 0.0,
+            'flows': flows,
+        }
+
+
+CLEANUP_TABLES = ('operations', 'daily_totals', 'balances', 'users')
+
+
+async def cleanup(pool):
+    """Удаляет данные синтетических пользователей"""
+    if finance_bot.DB_BACKEND == 'sqlite':
+        async with pool.transaction() as conn:
+            for table in CLEANUP_TABLES:
+                await conn.execute(f"DELETE FROM {table} WHERE chat_id >= ?", (CHAT_ID_BASE,))
+        return
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            for table in CLEANUP_TABLES:
+                await conn.execute(f"DELETE FROM {table} WHERE chat_id >= $1", CHAT_ID_BASE)
+
+
+def start_currency_service() -> str:
+    """Запускает currency_service в фоновом потоке, возвращает его адрес"""
+    from werkzeug.serving import make_server
+    from currency_service import app
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+def print_results(results: dict):
+    print(f"Пользователей: {results['users']}, обновлений: {results['updates']}, "
+          f"ошибок: {results['errors']}, отклонено ограничением частоты: {results['throttled']}")
+    if results['outbound']:
+        print(f"Очередь исходящих: запросов к Telegram {results['bot_requests']}, "
+              f"ответов 429: {results['retry_after']}")
+    print(f"Время: {results['elapsed_s']} с, {results['updates_per_s']} обновлений/с")
+    print(f"{'сценарий':<18}{'кол-во':>8}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}")
+    for name, flow in results['flows'].items():
+        print(f"{name:<18}{flow['count']:>8}{flow['p50_ms']:>10}{flow['p95_ms']:>10}{flow['p99_ms']:>10}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест финансового бота")
+    parser.add_argument('--users', type=int, default=100, help="число одновременных пользователей")
+    parser.add_argument('--operations', type=int, default=5, help="операций на пользователя")
+    parser.add_argument('--reports', type=int, default=1, help="пар отчетов на пользователя")
+    parser.add_argument('--api-latency', type=float, default=0.0,
+                        help="имитация задержки ответа Telegram, мс")
+    parser.add_argument('--json', help="сохранить результаты в файл")
+    parser.add_argument('--max-p95', type=float,
+                        help="код возврата 1, если p95 какого-либо сценария больше, мс")
+    parser.add_argument('--keep-data', action='store_true', help="не удалять созданные данные")
+    parser.add_argument('--throttle', action='store_true',
+                        help="не отключать ограничение частоты запросов")
+    parser.add_argument('--outbound', action='store_true',
+                        help="отправлять ответы через очередь исходящих сообщений бота")
+    parser.add_argument('--flood', type=int, default=0,
+                        help="отвечать 429 на каждую N-ю отправку (требует --outbound)")
+    args = parser.parse_args()
+    if args.flood and not args.outbound:
+        parser.error("--flood без --outbound: повторять отправку после 429 некому")
+
+    # Журнал бота на каждое действие сильно искажает результаты
+    logging.getLogger().setLevel(logging.WARNING)
+
+    currency_url = finance_bot.CURRENCY_SERVICE_URL or start_currency_service()
+    session = StubSession(latency=args.api_latency / 1000, flood_every=args.flood)
+    if args.outbound:
+        session.middleware(finance_bot.outbound)
+    bot = Bot(token=finance_bot.BOT_TOKEN, session=session)
+
+    db_pool = await finance_bot.create_db_pool()
+    repo = finance_bot.create_repository(db_pool)
+    currency_client = finance_bot.CurrencyClient(currency_url, **finance_bot.CURRENCY_CLIENT_CONFIG)
+    operation_writer = None
+    if finance_bot.WRITE_BEHIND:
+        operation_writer = finance_bot.OperationWriter(repo, **finance_bot.WRITE_BEHIND_CONFIG)
+    try:
+        await finance_bot.init_db(db_pool)
+        await cleanup(db_pool)
+        if operation_writer is not None:
+            operation_writer.start()
+        finance_bot.dp["repo"] = repo
+        finance_bot.dp["currency_client"] = currency_client
+        finance_bot.dp["operation_writer"] = operation_writer
+
+        test = LoadTest(bot, args.users, args.operations, args.reports)
+        results = test.results(await test.run())
+        results['bot_requests'] = session.requests
+        results['errors'] += session.error_replies
+        results['throttled'] = session.throttled_replies
+        results['outbound'] = args.outbound
+        results['retry_after'] = session.retry_after_replies
+    finally:
+        if operation_writer is not None:
+            await operation_writer.close()
+        await currency_client.close()
+        if not args.keep_data:
+            await cleanup(db_pool)
+        await db_pool.close()
+        await finance_bot.storage.close()
+
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+    slow = [name for name, flow in results['flows'].items()
+            if args.max_p95 is not None and flow['p95_ms'] > args.max_p95]
+    if slow or results['errors']:
+        for name in slow:
+            print(f"❌ {name}: p95 больше {args.max_p95} мс")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,348 @@
+import time
+import inspect
+import logging
+import functools
+from collections import defaultdict
+from contextlib import aclosing, contextmanager
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.types import TelegramObject
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Границы интервалов гистограмм задержек, в секундах
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _format_labels(names: Iterable[str], values: Iterable[Any], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+
+    def collect(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[tuple, float] = defaultdict(float)
+
+    def inc(self, *label_values, amount: float = 1):
+        self._values[label_values] += amount
+
+    def collect(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+            for key, value in self._values.items()
+        ]
+
+
+class Gauge(Metric):
+    """Значение вычисляется при каждом сборе метрик функцией callback,
+    которая возвращает словарь {значения меток: значение}"""
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = (),
+                 callback: Optional[Callable[[], Dict[tuple, float]]] = None):
+        super().__init__(name, documentation, labels)
+        self.callback = callback
+
+    def collect(self) -> List[str]:
+        if self.callback is None:
+            return []
+        try:
+            values = self.callback()
+        except Exception as e:
+            logger.error(f"Ошибка при сборе метрики {self.name}: {str(e)}")
+            return []
+        return [
+            f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+            for key, value in values.items()
+        ]
+
+
+class CallbackCounter(Gauge):
+    """Счетчик, который ведет сам объект бота: значение читается callback
+    при сборе, как у Gauge, но растет только вверх и экспортируется как counter"""
+    type = "counter"
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = buckets
+        self._counts: Dict[tuple, List[int]] = {}
+        self._sums: Dict[tuple, float] = defaultdict(float)
+
+    def observe(self, value: float, *label_values):
+        counts = self._counts.get(label_values)
+        if counts is None:
+            counts = self._counts[label_values] = [0] * (len(self.buckets) + 1)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[-1] += 1
+        self._sums[label_values] += value
+
+    @contextmanager
+    def time(self, *label_values):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *label_values)
+
+    def collect(self) -> List[str]:
+        lines = []
+        for key, counts in self._counts.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(self._sums[key])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        """Все метрики в текстовом формате Prometheus"""
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.header())
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+HANDLER_SECONDS = REGISTRY.register(Histogram(
+    "bot_handler_seconds", "Время работы обработчиков бота", ("handler",)
+))
+HANDLER_ERRORS = REGISTRY.register(Counter(
+    "bot_handler_errors_total", "Необработанные исключения в обработчиках", ("handler",)
+))
+FSM_UPDATES = REGISTRY.register(Counter(
+    "bot_fsm_updates_total", "Обновления по состоянию FSM пользователя", ("state",)
+))
+DB_QUERY_SECONDS = REGISTRY.register(Histogram(
+    "db_query_seconds", "Время выполнения запросов к БД", ("statement",)
+))
+DB_QUERY_ERRORS = REGISTRY.register(Counter(
+    "db_query_errors_total", "Ошибки запросов к БД", ("statement",)
+))
+CURRENCY_REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "currency_request_seconds", "Время запросов к сервису курсов валют"
+))
+CURRENCY_REQUEST_ERRORS = REGISTRY.register(Counter(
+    "currency_request_errors_total", "Неудачные запросы к сервису курсов валют"
+))
+CURRENCY_CIRCUIT_REJECTED = REGISTRY.register(Counter(
+    "currency_circuit_rejected_total", "Запросы к сервису курсов, не выполненные из-за разомкнутой цепи"
+))
+OUTBOUND_WAIT_SECONDS = REGISTRY.register(Histogram(
+    "bot_outbound_wait_seconds", "Ожидание исходящих запросов в очереди отправки", ("priority",)
+))
+OUTBOUND_RETRY_AFTER = REGISTRY.register(Counter(
+    "bot_outbound_retry_after_total", "Ответы Telegram 429 (retry_after) на исходящие запросы"
+))
+
+
+def timed_query(func):
+    """Декоратор методов репозитория: время и ошибки запроса по имени метода"""
+    statement = func.__name__
+
+    if inspect.isasyncgenfunction(func):
+        # Для генераторов учитывается только время получения строк,
+        # время обработки их вызывающим кодом в метрику не попадает
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            elapsed = 0.0
+            try:
+                async with aclosing(func(*args, **kwargs)) as rows:
+                    while True:
+                        started = time.perf_counter()
+                        try:
+                            item = await rows.__anext__()
+                        except StopAsyncIteration:
+                            break
+                        finally:
+                            elapsed += time.perf_counter() - started
+                        yield item
+            except Exception:
+                DB_QUERY_ERRORS.inc(statement)
+                raise
+            finally:
+                DB_QUERY_SECONDS.observe(elapsed, statement)
+        return wrapper
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        with DB_QUERY_SECONDS.time(statement):
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                DB_QUERY_ERRORS.inc(statement)
+                raise
+    return wrapper
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Внутренний middleware: время работы и ошибки каждого обработчика"""
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any]
+    ) -> Any:
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object else "unknown"
+        FSM_UPDATES.inc(data.get("raw_state") or "none")
+        with HANDLER_SECONDS.time(name):
+            try:
+                return await handler(event, data)
+            except Exception:
+                HANDLER_ERRORS.inc(name)
+                raise
+
+
+def register_runtime_metrics(pool, operation_writer=None, storage=None, outbound=None,
+                             currency_client=None, digest_scheduler=None):
+    """Метрики, которые снимаются с объектов бота в момент сбора:
+    занятость пула подключений, очередь отложенной записи, состояния FSM,
+    очередь исходящих сообщений, состояние клиента курсов валют, рассылка дайджестов"""
+    REGISTRY.register(Gauge(
+        "db_pool_connections", "Подключения пула БД", ("state",),
+        callback=lambda: {
+            ("size",): pool.get_size(),
+            ("idle",): pool.get_idle_size(),
+            ("in_use",): pool.get_size() - pool.get_idle_size(),
+            ("max",): pool.get_max_size(),
+        }
+    ))
+
+    if operation_writer is not None:
+        REGISTRY.register(Gauge(
+            "write_behind_queue_depth", "Операции в очереди отложенной записи",
+            callback=lambda: {(): operation_writer.queue_depth}
+        ))
+        REGISTRY.register(CallbackCounter(
+            "write_behind_batches_total", "Пачки отложенной записи", ("result",),
+            callback=lambda: {
+                ("ok",): operation_writer.batches_total,
+                ("failed",): operation_writer.failed_batches_total,
+            }
+        ))
+        REGISTRY.register(CallbackCounter(
+            "write_behind_operations_total", "Операции, сохраненные отложенной записью",
+            callback=lambda: {(): operation_writer.operations_total}
+        ))
+        REGISTRY.register(Gauge(
+            "write_behind_last_batch_size", "Размер последней сохраненной пачки",
+            callback=lambda: {(): operation_writer.last_batch_size}
+        ))
+        REGISTRY.register(Gauge(
+            "write_behind_max_batch_size", "Наибольший размер сохраненной пачки",
+            callback=lambda: {(): operation_writer.max_batch_size}
+        ))
+
+    if outbound is not None:
+        REGISTRY.register(Gauge(
+            "bot_outbound_queue_depth", "Исходящие запросы, ожидающие отправки", ("queue",),
+            callback=outbound.queue_depth
+        ))
+
+    if currency_client is not None:
+        REGISTRY.register(Gauge(
+            "currency_circuit_state", "Состояние цепи запросов к сервису курсов (1 - текущее)", ("state",),
+            callback=lambda: {
+                (state,): int(currency_client.breaker.state == state)
+                for state in ("closed", "open", "half_open")
+            }
+        ))
+        REGISTRY.register(Gauge(
+            "currency_rates_age_seconds", "Возраст таблицы курсов валют",
+            callback=lambda: ({} if currency_client.rates_age() is None
+                              else {(): currency_client.rates_age()})
+        ))
+
+    if digest_scheduler is not None:
+        REGISTRY.register(CallbackCounter(
+            "bot_digests_total", "Отправка дайджестов", ("result",),
+            callback=lambda: {
+                ("sent",): digest_scheduler.sent_total,
+                ("failed",): digest_scheduler.failed_total,
+            }
+        ))
+
+    # Пересчитать состояния можно только у хранилища в памяти процесса,
+    # для redis и postgres остается счетчик bot_fsm_updates_total
+    if isinstance(storage, MemoryStorage):
+        def fsm_states():
+            counts = defaultdict(int)
+            for record in storage.storage.values():
+                if record.state is not None:
+                    counts[(record.state,)] += 1
+            return counts
+
+        REGISTRY.register(Gauge(
+            "bot_fsm_states", "Пользователи в каждом состоянии FSM", ("state",),
+            callback=fsm_states
+        ))
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(text=REGISTRY.render(), content_type="text/plain", charset="utf-8",
+                        headers={"X-Content-Type-Options": "nosniff"})
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    """Запускает HTTP-сервер с метриками по адресу /metrics"""
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,128 @@
+import math
+import time
+import logging
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import CallbackQuery, Message, TelegramObject, Update
+
+logger = logging.getLogger(__name__)
+
+
+class TTLCache:
+    """Ограниченный по размеру LRU-кэш со временем жизни записей"""
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+
+        value, expires_at = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return default
+
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (value, time.monotonic() + self.ttl)
+        self._data.move_to_end(key)
+        # Вытесняем самые давно использованные записи
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        return default if item is None else item[0]
+
+    def __len__(self):
+        return len(self._data)
+
+
+class UserMiddleware(BaseMiddleware):
+    """Один раз на апдейт определяет, зарегистрирован ли пользователь.
+
+    Результат берется из кэша, а при промахе - из таблицы users.
+    В обработчики передаются user_registered и user_cache.
+    """
+
+    def __init__(self, cache: TTLCache):
+        self.cache = cache
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any]
+    ) -> Any:
+        user = data.get("event_from_user")
+        data["user_cache"] = self.cache
+        if user is None:
+            data["user_registered"] = False
+            return await handler(event, data)
+
+        registered = self.cache.get(user.id)
+        if registered is None:
+            try:
+                registered = await data["repo"].is_registered(user.id)
+            except Exception as e:
+                logger.error(f"Ошибка при проверке пользователя: {str(e)}")
+                if isinstance(event, Update) and event.message:
+                    await event.message.answer("⚠️ Произошла ошибка. Пожалуйста, попробуйте позже.")
+                return None
+            self.cache.set(user.id, registered)
+
+        data["user_registered"] = registered
+        return await handler(event, data)
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Ограничивает частоту запросов каждого чата по алгоритму token bucket.
+
+    Ведро вмещает burst жетонов и пополняется со скоростью rate жетонов
+    в секунду. Обработчик списывает столько жетонов, сколько указано в его
+    флаге throttle_cost (по умолчанию 1). Неиспользуемое дольше burst / rate
+    секунд ведро уже полное, как новое, поэтому такие записи вытесняются.
+    """
+
+    def __init__(self, rate: float = 1.0, burst: float = 10.0, maxsize: int = 1000000):
+        self.rate = rate
+        self.burst = burst
+        # Значения: (жетоны, время обновления, предупреждение уже отправлено)
+        self.buckets = TTLCache(maxsize=maxsize, ttl=burst / rate)
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any]
+    ) -> Any:
+        chat = data.get("event_chat") or data.get("event_from_user")
+        if chat is None:
+            return await handler(event, data)
+
+        cost = min(get_flag(data, "throttle_cost", default=1), self.burst)
+        now = time.monotonic()
+        tokens, updated, warned = self.buckets.get(chat.id, (self.burst, now, False))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+
+        if tokens < cost:
+            # Повторные запросы во время ожидания отбрасываются молча
+            if not warned:
+                wait = math.ceil((cost - tokens) / self.rate)
+                text = f"⏳ Слишком много запросов. Пожалуйста, подождите {wait} сек. и повторите."
+                if isinstance(event, (Message, CallbackQuery)):
+                    await event.answer(text)
+            self.buckets.set(chat.id, (tokens, now, True))
+            return None
+
+        self.buckets.set(chat.id, (tokens - cost, now, False))
+        return await handler(event, data)
\ No newline at end of file
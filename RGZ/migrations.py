@@ -0,0 +1,229 @@
+import os
+import sys
+import json
+import asyncio
+import logging
+from datetime import date, timedelta
+from typing import List
+
+import asyncpg
+
+import repository
+
+logger = logging.getLogger(__name__)
+
+# Версионированные миграции схемы: (версия, описание, SQL).
+# Уже примененные версии хранятся в schema_migrations, новые миграции
+# добавляются только в конец списка.
+MIGRATIONS = [
+    (1, "base tables",
+     "CREATE TABLE IF NOT EXISTS users ("
+     "id SERIAL PRIMARY KEY, "
+     "chat_id BIGINT NOT NULL, "
+     "name TEXT NOT NULL); "
+     "CREATE TABLE IF NOT EXISTS operations ("
+     "id SERIAL PRIMARY KEY, "
+     "date DATE NOT NULL, "
+     "sum NUMERIC NOT NULL, "
+     "chat_id BIGINT NOT NULL, "
+     "type_operation VARCHAR(20) NOT NULL)"),
+    (2, "unique users.chat_id",
+     # Сначала убираем дубликаты, оставшиеся от регистрации без ограничения
+     "DELETE FROM users a USING users b WHERE a.chat_id = b.chat_id AND a.ctid > b.ctid; "
+     "DO $$ BEGIN "
+     "IF NOT EXISTS ("
+     "SELECT 1 FROM pg_constraint c "
+     "JOIN pg_attribute a ON a.attrelid = c.conrelid AND a.attnum = ANY(c.conkey) "
+     "WHERE c.conrelid = 'users'::regclass AND c.contype IN ('p', 'u') "
+     "AND a.attname = 'chat_id' AND array_length(c.conkey, 1) = 1) THEN "
+     "ALTER TABLE users ADD CONSTRAINT users_chat_id_key UNIQUE (chat_id); "
+     "END IF; "
+     "END $$"),
+    (3, "operations (chat_id, date, id) index",
+     "CREATE INDEX IF NOT EXISTS operations_chat_date_id_idx "
+     "ON operations (chat_id, date DESC, id DESC)"),
+    (4, "daily_totals rollup",
+     "CREATE TABLE IF NOT EXISTS daily_totals ("
+     "chat_id BIGINT NOT NULL, "
+     "date DATE NOT NULL, "
+     "income NUMERIC NOT NULL DEFAULT 0, "
+     "expense NUMERIC NOT NULL DEFAULT 0, "
+     "operations INTEGER NOT NULL DEFAULT 0, "
+     "PRIMARY KEY (chat_id, date)); "
+     # Уже существующие строки итогов не трогаем, дополняем недостающие
+     "INSERT INTO daily_totals (chat_id, date, income, expense, operations) "
+     "SELECT chat_id, date, "
+     "COALESCE(SUM(sum) FILTER (WHERE type_operation = 'income'), 0), "
+     "COALESCE(SUM(sum) FILTER (WHERE type_operation = 'expense'), 0), "
+     "COUNT(*) "
+     "FROM operations GROUP BY chat_id, date "
+     "ON CONFLICT (chat_id, date) DO NOTHING"),
+    (5, "balances",
+     "CREATE TABLE IF NOT EXISTS balances ("
+     "chat_id BIGINT PRIMARY KEY, "
+     "income NUMERIC NOT NULL DEFAULT 0, "
+     "expense NUMERIC NOT NULL DEFAULT 0, "
+     "operations INTEGER NOT NULL DEFAULT 0, "
+     "updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()); "
+     "INSERT INTO balances (chat_id, income, expense, operations) "
+     "SELECT chat_id, "
+     "COALESCE(SUM(sum) FILTER (WHERE type_operation = 'income'), 0), "
+     "COALESCE(SUM(sum) FILTER (WHERE type_operation = 'expense'), 0), "
+     "COUNT(*) "
+     "FROM operations GROUP BY chat_id "
+     "ON CONFLICT (chat_id) DO NOTHING"),
+    (6, "digest subscriptions",
+     "CREATE TABLE IF NOT EXISTS digest_subscriptions ("
+     "chat_id BIGINT PRIMARY KEY, "
+     "period TEXT NOT NULL CHECK (period IN ('week', 'month')), "
+     # Начало периода, в котором дайджест уже отправлен
+     "last_sent_at DATE); "
+     "CREATE INDEX IF NOT EXISTS digest_subscriptions_period_idx "
+     "ON digest_subscriptions (period, last_sent_at)"),
+]
+
+# Индексы, без которых горячие запросы переходят на полный просмотр таблиц
+EXPECTED_INDEXES = {
+    "operations_chat_date_id_idx": "operations",
+    "daily_totals_pkey": "daily_totals",
+    "balances_pkey": "balances",
+    "digest_subscriptions_period_idx": "digest_subscriptions",
+}
+
+# Запросы отчетов и пример параметров для проверки их планов
+REPORT_QUERIES = {
+    "recent_operations": (repository.RECENT_OPERATIONS, (1, 10)),
+    "summary": (repository.SUMMARY, (1, "month")),
+    "summary_for_period": (repository.SUMMARY_FOR_PERIOD, (1, "day", timedelta(weeks=1))),
+    "daily_totals": (repository.DAILY_TOTALS, (1,)),
+    "daily_totals_for_period": (repository.DAILY_TOTALS_FOR_PERIOD, (1, timedelta(weeks=1))),
+    "operations_for_period": (repository.OPERATIONS_FOR_PERIOD, (1, timedelta(weeks=1), 500)),
+    "operations_page_older_for_period": (
+        repository.OPERATIONS_PAGE_OLDER_FOR_PERIOD, (1, date(2025, 1, 1), 1, timedelta(weeks=1), 500)
+    ),
+    "export": (repository.EXPORT, (1,)),
+    "export_for_period": (repository.EXPORT_FOR_PERIOD, (1, timedelta(weeks=1))),
+    "operations_page_older": (repository.OPERATIONS_PAGE_OLDER, (1, date(2025, 1, 1), 1, 10)),
+    "operations_page_newer": (repository.OPERATIONS_PAGE_NEWER, (1, date(2025, 1, 1), 1, 10)),
+    "user_exists": (repository.USER_EXISTS, (1,)),
+    "balance": (repository.BALANCE, (1,)),
+}
+# Произвольный номер блокировки, чтобы миграции не выполнялись одновременно
+MIGRATIONS_LOCK_ID = 727401
+
+
+async def run_migrations(conn: asyncpg.Connection) -> List[int]:
+    """Применяет недостающие миграции. Возвращает номера примененных версий"""
+    # Несколько экземпляров бота могут стартовать одновременно. Блокировка
+    # берется до CREATE TABLE IF NOT EXISTS: параллельные CREATE одной таблицы
+    # падают на уникальности имени в pg_type
+    await conn.execute("SELECT pg_advisory_lock($1)", MIGRATIONS_LOCK_ID)
+    try:
+        await conn.execute(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            "version INTEGER PRIMARY KEY, "
+            "name TEXT NOT NULL, "
+            "applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW())"
+        )
+        applied = {row['version'] for row in await conn.fetch("SELECT version FROM schema_migrations")}
+        done = []
+        for version, name, sql in MIGRATIONS:
+            if version in applied:
+                continue
+            async with conn.transaction():
+                await conn.execute(sql)
+                await conn.execute(
+                    "INSERT INTO schema_migrations (version, name) VALUES ($1, $2)",
+                    version, name
+                )
+            logger.info(f"Применена миграция {version}: {name}")
+            done.append(version)
+        return done
+    finally:
+        await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATIONS_LOCK_ID)
+
+
+async def find_missing_indexes(conn: asyncpg.Connection) -> List[str]:
+    """Возвращает ожидаемые индексы, которых нет в базе"""
+    existing = {
+        row['indexname'] for row in await conn.fetch(
+            "SELECT indexname FROM pg_indexes WHERE tablename = ANY($1::text[])",
+            list(set(EXPECTED_INDEXES.values()))
+        )
+    }
+    return [name for name in EXPECTED_INDEXES if name not in existing]
+
+
+INDEX_SCANS = ("Index Scan", "Index Only Scan", "Bitmap Index Scan")
+
+
+def _full_scans(plan: dict) -> List[str]:
+    """Узлы плана, читающие таблицу или индекс целиком"""
+    problems = []
+    node_type = plan.get("Node Type")
+    if node_type == "Seq Scan":
+        problems.append(f"полный просмотр таблицы {plan.get('Relation Name')}")
+    elif node_type in INDEX_SCANS and "Index Cond" not in plan:
+        # Индекс подошел только для сортировки, но не для отбора строк
+        problems.append(f"полный просмотр индекса {plan.get('Index Name')}")
+    for child in plan.get("Plans", []):
+        problems.extend(_full_scans(child))
+    return problems
+
+
+async def explain_report_queries(conn: asyncpg.Connection) -> List[str]:
+    """Проверяет через EXPLAIN, что запросы отчетов могут обойтись индексами.
+
+    Полный просмотр запрещается на время проверки (enable_seqscan = off):
+    если планировщик все равно выбирает Seq Scan или читает индекс без
+    условия отбора, подходящего индекса нет.
+    """
+    problems = []
+    async with conn.transaction():
+        await conn.execute("SET LOCAL enable_seqscan = off")
+        for name, (query, args) in REPORT_QUERIES.items():
+            plan_json = await conn.fetchval(f"EXPLAIN (FORMAT JSON) {query}", *args)
+            plan = json.loads(plan_json)[0]["Plan"]
+            problems.extend(f"{name}: {problem}" for problem in _full_scans(plan))
+    return problems
+
+
+async def check_schema(conn: asyncpg.Connection) -> List[str]:
+    """Недостающие индексы и запросы отчетов с полным просмотром (пусто - все в порядке)"""
+    problems = [f"нет индекса {name}" for name in await find_missing_indexes(conn)]
+    problems.extend(await explain_report_queries(conn))
+    return problems
+
+
+async def main():
+    """Применяет миграции и проверяет индексы и планы запросов отчетов.
+
+    Код возврата 1, если индекса не хватает или план запроса отчета
+    содержит полный просмотр, - так проверку можно запускать в CI.
+    """
+    conn = await asyncpg.connect(
+        host=os.getenv('DB_HOST'),
+        port=os.getenv('DB_PORT'),
+        user=os.getenv('DB_USER'),
+        password=os.getenv('DB_PASSWORD'),
+        database=os.getenv('DB_NAME')
+    )
+    try:
+        await run_migrations(conn)
+        problems = await check_schema(conn)
+    finally:
+        await conn.close()
+
+    for problem in problems:
+        print(f"❌ {problem}")
+    if problems:
+        sys.exit(1)
+    print(f"✅ Схема в порядке, проверено запросов: {len(REPORT_QUERIES)}")
+
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
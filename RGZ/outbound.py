@@ -0,0 +1,163 @@
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import List, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import TelegramMethod
+
+from metrics import OUTBOUND_RETRY_AFTER, OUTBOUND_WAIT_SECONDS
+from middlewares import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты отправки: ответы пользователям раньше массовых рассылок
+INTERACTIVE = 0
+BULK = 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BULK: "bulk"}
+
+_priority: ContextVar[int] = ContextVar("outbound_priority", default=INTERACTIVE)
+
+# Методы, на которые распространяются лимиты Telegram на отправку сообщений
+LIMITED_PREFIXES = ("Send", "Edit", "Copy", "Forward")
+
+
+@contextmanager
+def bulk_priority():
+    """Запросы внутри блока отправляются с низким приоритетом (рассылки)"""
+    token = _priority.set(BULK)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class PriorityLimiter:
+    """Общий token bucket, выдающий жетоны ожидающим по приоритету.
+
+    Пока жетонов нет, запросы ждут в куче (приоритет, порядок поступления),
+    и освободившийся жетон достается самому приоритетному из них.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._order = itertools.count()
+        self._pump_task: Optional[asyncio.Task] = None
+
+    def waiting(self, priority: int) -> int:
+        return sum(1 for p, _, future in self._waiters if p == priority and not future.done())
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, priority: int):
+        self._refill()
+        if not self._waiters and self._tokens >= 1:
+            self._tokens -= 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._order), future))
+        if self._pump_task is None or self._pump_task.done():
+            self._pump_task = asyncio.create_task(self._pump())
+        await future
+
+    async def _pump(self):
+        while self._waiters:
+            self._refill()
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                continue
+            _, _, future = heapq.heappop(self._waiters)
+            # Отмененные ожидания жетон не забирают
+            if not future.done():
+                self._tokens -= 1
+                future.set_result(None)
+
+
+class OutboundQueue(BaseRequestMiddleware):
+    """Очередь исходящих запросов бота с учетом лимитов Telegram.
+
+    Подключается к сессии бота (bot.session.middleware) и пропускает
+    отправку сообщений через два ограничителя:
+    - на чат: не больше chat_rate сообщений в секунду (с запасом chat_burst);
+    - общий: не больше global_rate в секунду, ответы пользователям
+      обслуживаются раньше рассылок (см. bulk_priority).
+    На ответ 429 запрос повторяется через retry_after секунд,
+    а чат на это время приостанавливается.
+    """
+
+    def __init__(self, global_rate: float = 30, chat_rate: float = 1, chat_burst: float = 5,
+                 max_retries: int = 3, max_chats: int = 100000):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.limiter = PriorityLimiter(global_rate, global_rate)
+        # Значения: (жетоны, время обновления); жетоны могут уходить в минус -
+        # это очередь уже зарезервированных отправок
+        self._chats = TTLCache(maxsize=max_chats, ttl=chat_burst / chat_rate + 60)
+        self.chat_waiting = 0
+
+    def queue_depth(self) -> dict:
+        return {
+            ("interactive",): self.limiter.waiting(INTERACTIVE),
+            ("bulk",): self.limiter.waiting(BULK),
+            ("chat",): self.chat_waiting,
+        }
+
+    def _reserve(self, chat_id, extra_delay: float = 0.0) -> float:
+        """Резервирует отправку в чат и возвращает, сколько секунд ждать"""
+        now = time.monotonic()
+        tokens, updated = self._chats.get(chat_id, (self.chat_burst, now))
+        tokens = min(self.chat_burst, tokens + (now - updated) * self.chat_rate)
+        if extra_delay:
+            # После retry_after запас не используется: ждем не меньше паузы
+            tokens = min(tokens, 1) - extra_delay * self.chat_rate
+        tokens -= 1
+        self._chats.set(chat_id, (tokens, now))
+        return max(0.0, -tokens / self.chat_rate)
+
+    async def __call__(
+            self,
+            make_request: NextRequestMiddlewareType,
+            bot: Bot,
+            method: TelegramMethod
+    ):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None or not type(method).__name__.startswith(LIMITED_PREFIXES):
+            return await make_request(bot, method)
+
+        priority = _priority.get()
+        retry_after = 0.0
+        for attempt in range(self.max_retries + 1):
+            started = time.monotonic()
+            delay = self._reserve(chat_id, retry_after)
+            if delay:
+                self.chat_waiting += 1
+                try:
+                    await asyncio.sleep(delay)
+                finally:
+                    self.chat_waiting -= 1
+            await self.limiter.acquire(priority)
+            OUTBOUND_WAIT_SECONDS.observe(time.monotonic() - started, PRIORITY_NAMES[priority])
+
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                OUTBOUND_RETRY_AFTER.inc()
+                if attempt == self.max_retries:
+                    raise
+                logger.warning(f"Telegram просит подождать {e.retry_after} с перед отправкой в чат {chat_id}")
+                retry_after = e.retry_after
@@ -0,0 +1,129 @@
+import asyncpg
+from datetime import date, timedelta
+from typing import AsyncIterator, Callable, Dict, List, Mapping
+
+# Разбивка сводного отчета в зависимости от периода
+SUMMARY_BUCKETS = {
+    "За сегодня": "day",
+    "За неделю": "day",
+    "За месяц": "week",
+    "За все время": "month"
+}
+BUCKET_TITLES = {
+    "day": "По дням",
+    "week": "По неделям",
+    "month": "По месяцам"
+}
+# Сколько последних интервалов показывать в сводке
+MAX_SUMMARY_BUCKETS = 24
+# Лимит Telegram - 4096 символов, оставляем запас
+MAX_MESSAGE_LENGTH = 4000
+
+
+def format_bucket(bucket_date, bucket: str) -> str:
+    if bucket == "month":
+        return bucket_date.strftime('%m.%Y')
+    if bucket == "week":
+        return f"с {bucket_date.strftime('%d.%m.%Y')}"
+    return bucket_date.strftime('%d.%m.%Y')
+
+
+def bucket_start(day: date, bucket: str) -> date:
+    """Начало интервала, как date_trunc в PostgreSQL (неделя - с понедельника)"""
+    if bucket == "month":
+        return day.replace(day=1)
+    if bucket == "week":
+        return day - timedelta(days=day.weekday())
+    return day
+
+
+def convert_summary(daily: List[asyncpg.Record], bucket: str,
+                    rate_on: Callable[[date], float]) -> List[Dict]:
+    """Собирает сводку из дневных итогов, пересчитывая каждый день
+    по курсу на его дату. Строки - как у FinanceRepository.fetch_summary"""
+    buckets: Dict[date, Dict] = {}
+    totals = {'bucket': None, 'income': 0.0, 'expense': 0.0, 'operations': 0}
+
+    for row in daily:
+        rate = rate_on(row['date'])
+        income = float(row['income']) / rate
+        expense = float(row['expense']) / rate
+        start = bucket_start(row['date'], bucket)
+        item = buckets.get(start)
+        if item is None:
+            item = buckets[start] = {'bucket': start, 'income': 0.0, 'expense': 0.0, 'operations': 0}
+        for target in (item, totals):
+            target['income'] += income
+            target['expense'] += expense
+            target['operations'] += row['operations']
+
+    if totals['operations'] == 0:
+        return []
+    return [totals] + [buckets[start] for start in sorted(buckets)]
+
+
+def format_age(seconds: float) -> str:
+    """Возраст данных для сообщений пользователю: '5 мин', '2 ч 10 мин', '3 дн'"""
+    minutes = int(seconds // 60)
+    if minutes < 1:
+        return "меньше минуты"
+    if minutes < 60:
+        return f"{minutes} мин"
+    hours = minutes // 60
+    if hours < 48:
+        return f"{hours} ч {minutes % 60} мин"
+    return f"{hours // 24} дн"
+
+
+def format_summary(rows: List[Mapping], title: str, bucket: str, currency: str) -> str:
+    """Формирует текст сводного отчета (суммы в rows уже в валюте отчета)"""
+    totals, buckets = rows[0], rows[1:]
+    income = float(totals['income'])
+    expense = float(totals['expense'])
+
+    lines = [
+        f"📊 Сводка за {title} ({currency}):\n",
+        f"⬆️ Доходы: {income:.2f} {currency}",
+        f"⬇️ Расходы: {expense:.2f} {currency}",
+        f"💰 Итого: {income - expense:.2f} {currency}",
+        f"🧾 Операций: {totals['operations']}"
+    ]
+
+    if len(buckets) > 1:
+        lines.append(f"\n{BUCKET_TITLES[bucket]}:")
+        if len(buckets) > MAX_SUMMARY_BUCKETS:
+            lines.append(f"(последние {MAX_SUMMARY_BUCKETS})")
+            buckets = buckets[-MAX_SUMMARY_BUCKETS:]
+        for row in buckets:
+            lines.append(
+                f"{format_bucket(row['bucket'], bucket)}: "
+                f"+{float(row['income']):.2f} / -{float(row['expense']):.2f}"
+            )
+
+    return "\n".join(lines)
+
+
+async def iter_report_chunks(operations: AsyncIterator[asyncpg.Record], header: str,
+                             currency: str, rate_on: Callable[[date], float]) -> AsyncIterator[str]:
+    """Построчно формирует подробный отчет и отдает его частями,
+    каждая из которых помещается в одно сообщение Telegram.
+    Каждая операция пересчитывается по курсу на ее дату"""
+    lines = [header]
+    length = len(header)
+    has_operations = False
+
+    async for op in operations:
+        has_operations = True
+        amount = float(op['sum']) / rate_on(op['date'])
+        prefix = "⬆️" if op['type_operation'] == 'income' else "⬇️"
+        line = f"{prefix} {op['date'].strftime('%d.%m.%Y')} - {amount:.2f} {currency}"
+
+        if length + len(line) + 1 > MAX_MESSAGE_LENGTH:
+            yield "\n".join(lines)
+            lines, length = [], 0
+
+        lines.append(line)
+        length += len(line) + 1
+
+    if has_operations:
+        yield "\n".join(lines)
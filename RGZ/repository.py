@@ -0,0 +1,448 @@
+import zlib
+import asyncpg
+from io import BytesIO
+from datetime import date, timedelta
+from typing import AsyncIterator, List, Optional, Tuple
+
+from metrics import timed_query
+
+# Все запросы - неизменяемые строки: asyncpg подготавливает каждый из них
+# один раз на подключение пула и дальше переиспользует из кэша выражений.
+
+USER_EXISTS = "SELECT 1 FROM users WHERE chat_id = $1"
+# Повторная регистрация (например, двойное нажатие) не создает дубликат
+REGISTER_USER = (
+    "INSERT INTO users (chat_id, name) VALUES ($1, $2) "
+    "ON CONFLICT DO NOTHING RETURNING chat_id"
+)
+
+RECENT_OPERATIONS = (
+    "SELECT id, type_operation, sum, date FROM operations "
+    "WHERE chat_id = $1 ORDER BY date DESC, id DESC LIMIT $2"
+)
+# Постраничный просмотр операций по ключу (date, id) без OFFSET:
+# каждая страница - один проход по индексу от курсора
+OPERATIONS_PAGE_OLDER = (
+    "SELECT id, type_operation, sum, date FROM operations "
+    "WHERE chat_id = $1 AND (date, id) < ($2, $3) "
+    "ORDER BY date DESC, id DESC LIMIT $4"
+)
+OPERATIONS_PAGE_NEWER = (
+    "SELECT id, type_operation, sum, date FROM operations "
+    "WHERE chat_id = $1 AND (date, id) > ($2, $3) "
+    "ORDER BY date, id LIMIT $4"
+)
+
+DAILY_TOTALS_UPSERT = (
+    "INSERT INTO daily_totals (chat_id, date, income, expense, operations) "
+    "VALUES ($1, $2, $3, $4, $5) "
+    "ON CONFLICT (chat_id, date) DO UPDATE SET "
+    "income = daily_totals.income + EXCLUDED.income, "
+    "expense = daily_totals.expense + EXCLUDED.expense, "
+    "operations = daily_totals.operations + EXCLUDED.operations"
+)
+BALANCE_UPSERT = (
+    "INSERT INTO balances (chat_id, income, expense, operations) "
+    "VALUES ($1, $2, $3, $4) "
+    "ON CONFLICT (chat_id) DO UPDATE SET "
+    "income = balances.income + EXCLUDED.income, "
+    "expense = balances.expense + EXCLUDED.expense, "
+    "operations = balances.operations + EXCLUDED.operations, "
+    "updated_at = NOW()"
+)
+# Добавление операции вместе с обновлением дневных итогов и баланса - один запрос
+ADD_OPERATION = (
+    "WITH op AS ("
+    "INSERT INTO operations (chat_id, type_operation, sum, date) VALUES ($1, $2, $3, $4) "
+    "RETURNING id, chat_id, type_operation, sum, date), "
+    "totals AS ("
+    "INSERT INTO daily_totals (chat_id, date, income, expense, operations) "
+    "SELECT chat_id, date, "
+    "CASE WHEN type_operation = 'income' THEN sum ELSE 0 END, "
+    "CASE WHEN type_operation = 'expense' THEN sum ELSE 0 END, 1 FROM op "
+    "ON CONFLICT (chat_id, date) DO UPDATE SET "
+    "income = daily_totals.income + EXCLUDED.income, "
+    "expense = daily_totals.expense + EXCLUDED.expense, "
+    "operations = daily_totals.operations + EXCLUDED.operations), "
+    "balance AS ("
+    "INSERT INTO balances (chat_id, income, expense, operations) "
+    "SELECT chat_id, "
+    "CASE WHEN type_operation = 'income' THEN sum ELSE 0 END, "
+    "CASE WHEN type_operation = 'expense' THEN sum ELSE 0 END, 1 FROM op "
+    "ON CONFLICT (chat_id) DO UPDATE SET "
+    "income = balances.income + EXCLUDED.income, "
+    "expense = balances.expense + EXCLUDED.expense, "
+    "operations = balances.operations + EXCLUDED.operations, "
+    "updated_at = NOW()) "
+    "SELECT id FROM op"
+)
+# Изменение суммы, поправка дневных итогов и баланса на разницу
+# и возврат обновленной операции - тоже один запрос
+UPDATE_OPERATION_AMOUNT = (
+    "WITH old AS ("
+    "SELECT id, sum FROM operations WHERE id = $2 AND chat_id = $3 FOR UPDATE), "
+    "op AS ("
+    "UPDATE operations o SET sum = $1 FROM old WHERE o.id = old.id "
+    "RETURNING o.chat_id, o.type_operation, o.sum, o.date, o.sum - old.sum AS delta), "
+    "totals AS ("
+    "INSERT INTO daily_totals (chat_id, date, income, expense, operations) "
+    "SELECT chat_id, date, "
+    "CASE WHEN type_operation = 'income' THEN delta ELSE 0 END, "
+    "CASE WHEN type_operation = 'expense' THEN delta ELSE 0 END, 0 FROM op "
+    "ON CONFLICT (chat_id, date) DO UPDATE SET "
+    "income = daily_totals.income + EXCLUDED.income, "
+    "expense = daily_totals.expense + EXCLUDED.expense), "
+    "balance AS ("
+    "UPDATE balances b SET "
+    "income = b.income + CASE WHEN op.type_operation = 'income' THEN op.delta ELSE 0 END, "
+    "expense = b.expense + CASE WHEN op.type_operation = 'expense' THEN op.delta ELSE 0 END, "
+    "updated_at = NOW() "
+    "FROM op WHERE b.chat_id = op.chat_id) "
+    "SELECT type_operation, sum, date FROM op"
+)
+
+BALANCE = "SELECT income, expense, operations, updated_at FROM balances WHERE chat_id = $1"
+# Пользователи, у которых сохраненный баланс расходится с суммой операций
+BALANCE_DRIFT = (
+    "SELECT COALESCE(a.chat_id, b.chat_id) AS chat_id "
+    "FROM (SELECT chat_id, "
+    "COALESCE(SUM(sum) FILTER (WHERE type_operation = 'income'), 0) AS income, "
+    "COALESCE(SUM(sum) FILTER (WHERE type_operation = 'expense'), 0) AS expense, "
+    "COUNT(*) AS operations "
+    "FROM operations GROUP BY chat_id) a "
+    "FULL JOIN balances b ON b.chat_id = a.chat_id "
+    "WHERE (COALESCE(a.income, 0), COALESCE(a.expense, 0), COALESCE(a.operations, 0)) "
+    "IS DISTINCT FROM (COALESCE(b.income, 0), COALESCE(b.expense, 0), COALESCE(b.operations, 0))"
+)
+LOCK_BALANCE = "SELECT 1 FROM balances WHERE chat_id = $1 FOR UPDATE"
+# Пересчет баланса одного пользователя; возвращает chat_id, только если значение изменилось
+FIX_BALANCE = (
+    "INSERT INTO balances (chat_id, income, expense, operations) "
+    "SELECT $1::bigint, "
+    "COALESCE(SUM(sum) FILTER (WHERE type_operation = 'income'), 0), "
+    "COALESCE(SUM(sum) FILTER (WHERE type_operation = 'expense'), 0), "
+    "COUNT(*) "
+    "FROM operations WHERE chat_id = $1 "
+    "ON CONFLICT (chat_id) DO UPDATE SET "
+    "income = EXCLUDED.income, expense = EXCLUDED.expense, "
+    "operations = EXCLUDED.operations, updated_at = NOW() "
+    "WHERE (balances.income, balances.expense, balances.operations) "
+    "IS DISTINCT FROM (EXCLUDED.income, EXCLUDED.expense, EXCLUDED.operations) "
+    "RETURNING chat_id"
+)
+# Произвольный номер блокировки: сверку выполняет только одна реплика бота
+RECONCILE_LOCK_ID = 727402
+TRY_LOCK = "SELECT pg_try_advisory_lock($1)"
+UNLOCK = "SELECT pg_advisory_unlock($1)"
+
+GET_DIGEST = "SELECT period FROM digest_subscriptions WHERE chat_id = $1"
+SET_DIGEST = (
+    "INSERT INTO digest_subscriptions (chat_id, period, last_sent_at) VALUES ($1, $2, $3) "
+    "ON CONFLICT (chat_id) DO UPDATE SET period = EXCLUDED.period, last_sent_at = EXCLUDED.last_sent_at"
+)
+DELETE_DIGEST = "DELETE FROM digest_subscriptions WHERE chat_id = $1"
+# Дайджесты всех подписчиков одним запросом: подписки, по которым за период
+# $2 еще ничего не отправлено, помечаются отправленными (так несколько
+# экземпляров бота не отправят дайджест дважды), и для них сразу считаются
+# итоги по дневным итогам за [$3, $2)
+CLAIM_DIGESTS = (
+    "WITH due AS ("
+    "UPDATE digest_subscriptions SET last_sent_at = $2 "
+    "WHERE period = $1 AND (last_sent_at IS NULL OR last_sent_at < $2) "
+    "RETURNING chat_id) "
+    "SELECT due.chat_id, "
+    "COALESCE(SUM(t.income), 0) AS income, "
+    "COALESCE(SUM(t.expense), 0) AS expense, "
+    "COALESCE(SUM(t.operations), 0) AS operations "
+    "FROM due LEFT JOIN daily_totals t "
+    "ON t.chat_id = due.chat_id AND t.date >= $3 AND t.date < $2 "
+    "GROUP BY due.chat_id"
+)
+
+# Сводка строится по дневным итогам, а не по сырым операциям,
+# поэтому ее стоимость зависит от числа дней, а не операций.
+# ROLLUP добавляет строку с bucket = NULL - итоги за весь период
+SUMMARY = (
+    "SELECT date_trunc($2, date::timestamp)::date AS bucket, "
+    "COALESCE(SUM(income), 0) AS income, "
+    "COALESCE(SUM(expense), 0) AS expense, "
+    "COALESCE(SUM(operations), 0) AS operations "
+    "FROM daily_totals "
+    "WHERE chat_id = $1 "
+    "GROUP BY ROLLUP (1) ORDER BY bucket NULLS FIRST"
+)
+SUMMARY_FOR_PERIOD = (
+    "SELECT date_trunc($2, date::timestamp)::date AS bucket, "
+    "COALESCE(SUM(income), 0) AS income, "
+    "COALESCE(SUM(expense), 0) AS expense, "
+    "COALESCE(SUM(operations), 0) AS operations "
+    "FROM daily_totals "
+    "WHERE chat_id = $1 AND date >= (NOW() - $3::interval) "
+    "GROUP BY ROLLUP (1) ORDER BY bucket NULLS FIRST"
+)
+# Дневные итоги - для пересчета сводки в валюту по курсу на каждый день
+DAILY_TOTALS = (
+    "SELECT date, income, expense, operations FROM daily_totals "
+    "WHERE chat_id = $1 ORDER BY date"
+)
+DAILY_TOTALS_FOR_PERIOD = (
+    "SELECT date, income, expense, operations FROM daily_totals "
+    "WHERE chat_id = $1 AND date >= (NOW() - $2::interval) ORDER BY date"
+)
+
+# Операции для подробного отчета читаются страницами по ключу (date, id),
+# как в OPERATIONS_PAGE_OLDER; без периода первая страница - RECENT_OPERATIONS
+OPERATIONS_FOR_PERIOD = (
+    "SELECT id, type_operation, sum, date FROM operations "
+    "WHERE chat_id = $1 AND date >= (NOW() - $2::interval) "
+    "ORDER BY date DESC, id DESC LIMIT $3"
+)
+OPERATIONS_PAGE_OLDER_FOR_PERIOD = (
+    "SELECT id, type_operation, sum, date FROM operations "
+    "WHERE chat_id = $1 AND (date, id) < ($2, $3) AND date >= (NOW() - $4::interval) "
+    "ORDER BY date DESC, id DESC LIMIT $5"
+)
+
+EXPORT = (
+    "SELECT date, type_operation, sum FROM operations "
+    "WHERE chat_id = $1 ORDER BY date, id"
+)
+EXPORT_FOR_PERIOD = (
+    "SELECT date, type_operation, sum FROM operations "
+    "WHERE chat_id = $1 AND date >= (NOW() - $2::interval) ORDER BY date, id"
+)
+
+# Сколько операций подробного отчета читается за один запрос
+REPORT_PAGE_SIZE = 500
+
+
+class FinanceRepository:
+    """Работа с пользователями и операциями в PostgreSQL.
+
+    Обработчики бота обращаются к базе только через этот класс.
+    Каждый метод берет подключение из пула на время одного запроса,
+    время и ошибки запросов учитываются в метриках по имени метода.
+    """
+
+    def __init__(self, pool: asyncpg.Pool, acquire_timeout: Optional[float] = None):
+        self.pool = pool
+        self.acquire_timeout = acquire_timeout
+
+    def _acquire(self):
+        return self.pool.acquire(timeout=self.acquire_timeout)
+
+    # Пользователи
+    @timed_query
+    async def is_registered(self, chat_id: int) -> bool:
+        async with self._acquire() as conn:
+            return await conn.fetchval(USER_EXISTS, chat_id) is not None
+
+    @timed_query
+    async def register_user(self, chat_id: int, name: str) -> bool:
+        """Регистрирует пользователя. Возвращает False, если он уже был зарегистрирован"""
+        async with self._acquire() as conn:
+            return await conn.fetchval(REGISTER_USER, chat_id, name) is not None
+
+    # Операции
+    @timed_query
+    async def operations_page(self, chat_id: int, cursor: Optional[Tuple[date, int]] = None,
+                              older: bool = True, limit: int = 10) -> Tuple[List[asyncpg.Record], bool]:
+        """Страница операций (новые сверху) старше или новее курсора (date, id).
+
+        Без курсора возвращает самые новые операции. Второй элемент
+        результата - есть ли еще операции дальше в том же направлении.
+        """
+        async with self._acquire() as conn:
+            if cursor is None:
+                rows = await conn.fetch(RECENT_OPERATIONS, chat_id, limit + 1)
+            elif older:
+                rows = await conn.fetch(OPERATIONS_PAGE_OLDER, chat_id, *cursor, limit + 1)
+            else:
+                rows = await conn.fetch(OPERATIONS_PAGE_NEWER, chat_id, *cursor, limit + 1)
+
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if cursor is not None and not older:
+            rows.reverse()
+        return rows, has_more
+
+    @timed_query
+    async def add_operation(self, chat_id: int, type_operation: str, amount, operation_date) -> int:
+        """Сохраняет операцию и обновляет итоги дня. Возвращает ID операции"""
+        async with self._acquire() as conn:
+            return await conn.fetchval(ADD_OPERATION, chat_id, type_operation, amount, operation_date)
+
+    @timed_query
+    async def update_operation_amount(self, operation_id: int, chat_id: int,
+                                      amount) -> Optional[asyncpg.Record]:
+        """Меняет сумму операции пользователя и возвращает обновленную операцию
+        (или None, если операция не найдена)"""
+        async with self._acquire() as conn:
+            return await conn.fetchrow(UPDATE_OPERATION_AMOUNT, amount, operation_id, chat_id)
+
+    @timed_query
+    async def save_operations(self, operations: List[tuple]):
+        """Пакетно сохраняет операции (chat_id, type_operation, sum, date).
+
+        Операции загружаются через COPY, дневные итоги и балансы обновляются
+        через executemany в той же транзакции.
+        """
+        totals = {}
+        balances = {}
+        for chat_id, type_operation, amount, operation_date in operations:
+            income, expense = (amount, 0) if type_operation == 'income' else (0, amount)
+            for target, key in ((totals, (chat_id, operation_date)), (balances, chat_id)):
+                total_income, total_expense, count = target.get(key, (0, 0, 0))
+                target[key] = (total_income + income, total_expense + expense, count + 1)
+
+        async with self._acquire() as conn:
+            async with conn.transaction():
+                await conn.copy_records_to_table(
+                    'operations',
+                    records=operations,
+                    columns=['chat_id', 'type_operation', 'sum', 'date']
+                )
+                # Одинаковый порядок обновления строк исключает взаимные блокировки
+                await conn.executemany(
+                    DAILY_TOTALS_UPSERT,
+                    [(chat_id, operation_date, income, expense, count)
+                     for (chat_id, operation_date), (income, expense, count) in sorted(totals.items())]
+                )
+                await conn.executemany(
+                    BALANCE_UPSERT,
+                    [(chat_id, income, expense, count)
+                     for chat_id, (income, expense, count) in sorted(balances.items())]
+                )
+
+    # Баланс
+    @timed_query
+    async def get_balance(self, chat_id: int) -> Optional[asyncpg.Record]:
+        """Доходы, расходы и число операций пользователя (None, если операций не было)"""
+        async with self._acquire() as conn:
+            return await conn.fetchrow(BALANCE, chat_id)
+
+    @timed_query
+    async def reconcile_balances(self) -> List[int]:
+        """Сверяет балансы с таблицей operations и исправляет расхождения.
+
+        Баланс каждого подозрительного пользователя пересчитывается под
+        блокировкой его строки, чтобы не потерять одновременно добавляемые
+        операции. Возвращает chat_id, у которых баланс действительно отличался.
+        Если сверку уже выполняет другая реплика, ничего не делает.
+        """
+        async with self._acquire() as conn:
+            if not await conn.fetchval(TRY_LOCK, RECONCILE_LOCK_ID):
+                return []
+            try:
+                suspects = [row['chat_id'] for row in await conn.fetch(BALANCE_DRIFT)]
+                fixed = []
+                for chat_id in suspects:
+                    async with conn.transaction():
+                        await conn.execute(LOCK_BALANCE, chat_id)
+                        if await conn.fetchval(FIX_BALANCE, chat_id) is not None:
+                            fixed.append(chat_id)
+                return fixed
+            finally:
+                await conn.execute(UNLOCK, RECONCILE_LOCK_ID)
+
+    # Дайджесты
+    @timed_query
+    async def get_digest(self, chat_id: int) -> Optional[str]:
+        async with self._acquire() as conn:
+            return await conn.fetchval(GET_DIGEST, chat_id)
+
+    @timed_query
+    async def set_digest(self, chat_id: int, period: Optional[str], current_start: Optional[date] = None):
+        """Подписывает на дайджест за период week/month (None - отписка).
+        Первый дайджест придет за период, следующий за current_start"""
+        async with self._acquire() as conn:
+            if period is None:
+                await conn.execute(DELETE_DIGEST, chat_id)
+            else:
+                await conn.execute(SET_DIGEST, chat_id, period, current_start)
+
+    @timed_query
+    async def claim_digests(self, period: str, start: date, previous_start: date) -> List[asyncpg.Record]:
+        """Забирает неотправленные дайджесты за [previous_start, start) с итогами"""
+        async with self._acquire() as conn:
+            return await conn.fetch(CLAIM_DIGESTS, period, start, previous_start)
+
+    # Отчеты
+    @timed_query
+    async def fetch_summary(self, chat_id: int, bucket: str,
+                            period: Optional[timedelta]) -> List[asyncpg.Record]:
+        """Считает итоги и разбивку по интервалам на стороне БД.
+
+        Первая строка - итоги за период, остальные - по интервалам.
+        Если операций нет, возвращает пустой список.
+        """
+        async with self._acquire() as conn:
+            if period is None:
+                rows = await conn.fetch(SUMMARY, chat_id, bucket)
+            else:
+                rows = await conn.fetch(SUMMARY_FOR_PERIOD, chat_id, bucket, period)
+
+        if not rows or rows[0]['operations'] == 0:
+            return []
+        return rows
+
+    @timed_query
+    async def fetch_daily_totals(self, chat_id: int,
+                                 period: Optional[timedelta]) -> List[asyncpg.Record]:
+        """Итоги по дням за период (старые сверху)"""
+        async with self._acquire() as conn:
+            if period is None:
+                return await conn.fetch(DAILY_TOTALS, chat_id)
+            return await conn.fetch(DAILY_TOTALS_FOR_PERIOD, chat_id, period)
+
+    @timed_query
+    async def iter_operations(self, chat_id: int,
+                              period: Optional[timedelta]) -> AsyncIterator[asyncpg.Record]:
+        """Отдает операции за период (новые сверху) страницами по REPORT_PAGE_SIZE.
+
+        Каждая страница читается отдельным запросом от ключа (date, id)
+        последней строки, и подключение возвращается в пул до того, как
+        строки уходят потребителю (который может долго отправлять сообщения).
+        """
+        cursor = None
+        while True:
+            async with self._acquire() as conn:
+                if cursor is None and period is None:
+                    rows = await conn.fetch(RECENT_OPERATIONS, chat_id, REPORT_PAGE_SIZE)
+                elif cursor is None:
+                    rows = await conn.fetch(OPERATIONS_FOR_PERIOD, chat_id, period, REPORT_PAGE_SIZE)
+                elif period is None:
+                    rows = await conn.fetch(OPERATIONS_PAGE_OLDER, chat_id, *cursor, REPORT_PAGE_SIZE)
+                else:
+                    rows = await conn.fetch(OPERATIONS_PAGE_OLDER_FOR_PERIOD, chat_id, *cursor,
+                                            period, REPORT_PAGE_SIZE)
+            for row in rows:
+                yield row
+            if len(rows) < REPORT_PAGE_SIZE:
+                return
+            cursor = (rows[-1]['date'], rows[-1]['id'])
+
+    @timed_query
+    async def export_operations(self, chat_id: int, period: Optional[timedelta],
+                                compress: bool = False) -> bytes:
+        """Выгружает операции за период в CSV через COPY.
+
+        Данные приходят из БД порциями и сразу пишутся в буфер
+        (при compress=True - сжимаются в gzip на лету).
+        """
+        buffer = BytesIO()
+        compressor = zlib.compressobj(wbits=31) if compress else None
+
+        async def write(chunk: bytes):
+            buffer.write(compressor.compress(chunk) if compressor else chunk)
+
+        async with self._acquire() as conn:
+            if period is None:
+                await conn.copy_from_query(EXPORT, chat_id, output=write, format='csv', header=True)
+            else:
+                await conn.copy_from_query(EXPORT_FOR_PERIOD, chat_id, period,
+                                           output=write, format='csv', header=True)
+
+        if compressor:
+            buffer.write(compressor.flush())
+        return buffer.getvalue()
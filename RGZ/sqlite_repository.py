@@ -0,0 +1,637 @@
+import io
+import csv
+import zlib
+import json
+import asyncio
+import logging
+import sqlite3
+from contextlib import asynccontextmanager
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from typing import AsyncIterator, List, Optional, Tuple
+
+import aiosqlite
+
+from metrics import timed_query
+
+logger = logging.getLogger(__name__)
+
+# Даты хранятся текстом ISO (YYYY-MM-DD), суммы - с NUMERIC-аффинностью.
+# Колонки DATE/TIMESTAMP и вычисляемые колонки с пометкой "[DATE]"
+# возвращаются как date/datetime, как в asyncpg.
+sqlite3.register_adapter(date, date.isoformat)
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(" "))
+sqlite3.register_adapter(Decimal, float)
+sqlite3.register_converter("DATE", lambda value: date.fromisoformat(value.decode()))
+sqlite3.register_converter("TIMESTAMP", lambda value: datetime.fromisoformat(value.decode()))
+
+# Та же схема, что в migrations.MIGRATIONS (версии совпадают), в диалекте SQLite.
+# Каждая миграция - список отдельных выражений.
+MIGRATIONS = [
+    (1, "base tables", [
+        "CREATE TABLE IF NOT EXISTS users ("
+        "id INTEGER PRIMARY KEY, "
+        "chat_id INTEGER NOT NULL, "
+        "name TEXT NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS operations ("
+        "id INTEGER PRIMARY KEY, "
+        "date DATE NOT NULL, "
+        "sum NUMERIC NOT NULL, "
+        "chat_id INTEGER NOT NULL, "
+        "type_operation VARCHAR(20) NOT NULL)",
+    ]),
+    (2, "unique users.chat_id", [
+        "DELETE FROM users WHERE id NOT IN (SELECT MIN(id) FROM users GROUP BY chat_id)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS users_chat_id_key ON users (chat_id)",
+    ]),
+    (3, "operations (chat_id, date, id) index", [
+        "CREATE INDEX IF NOT EXISTS operations_chat_date_id_idx "
+        "ON operations (chat_id, date DESC, id DESC)",
+    ]),
+    (4, "daily_totals rollup", [
+        "CREATE TABLE IF NOT EXISTS daily_totals ("
+        "chat_id INTEGER NOT NULL, "
+        "date DATE NOT NULL, "
+        "income NUMERIC NOT NULL DEFAULT 0, "
+        "expense NUMERIC NOT NULL DEFAULT 0, "
+        "operations INTEGER NOT NULL DEFAULT 0, "
+        "PRIMARY KEY (chat_id, date)) WITHOUT ROWID",
+        "INSERT INTO daily_totals (chat_id, date, income, expense, operations) "
+        "SELECT chat_id, date, "
+        "COALESCE(SUM(sum) FILTER (WHERE type_operation = 'income'), 0), "
+        "COALESCE(SUM(sum) FILTER (WHERE type_operation = 'expense'), 0), "
+        "COUNT(*) "
+        "FROM operations WHERE true GROUP BY chat_id, date "
+        "ON CONFLICT (chat_id, date) DO NOTHING",
+    ]),
+    (5, "balances", [
+        "CREATE TABLE IF NOT EXISTS balances ("
+        "chat_id INTEGER PRIMARY KEY, "
+        "income NUMERIC NOT NULL DEFAULT 0, "
+        "expense NUMERIC NOT NULL DEFAULT 0, "
+        "operations INTEGER NOT NULL DEFAULT 0, "
+        "updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP)",
+        "INSERT INTO balances (chat_id, income, expense, operations) "
+        "SELECT chat_id, "
+        "COALESCE(SUM(sum) FILTER (WHERE type_operation = 'income'), 0), "
+        "COALESCE(SUM(sum) FILTER (WHERE type_operation = 'expense'), 0), "
+        "COUNT(*) "
+        "FROM operations WHERE true GROUP BY chat_id "
+        "ON CONFLICT (chat_id) DO NOTHING",
+    ]),
+    (6, "digest subscriptions", [
+        "CREATE TABLE IF NOT EXISTS digest_subscriptions ("
+        "chat_id INTEGER PRIMARY KEY, "
+        "period TEXT NOT NULL CHECK (period IN ('week', 'month')), "
+        "last_sent_at DATE)",
+        "CREATE INDEX IF NOT EXISTS digest_subscriptions_period_idx "
+        "ON digest_subscriptions (period, last_sent_at)",
+    ]),
+]
+
+# Первичные ключи daily_totals и balances в SQLite не являются отдельными
+# индексами, поэтому проверяются только именованные
+EXPECTED_INDEXES = {
+    "users_chat_id_key": "users",
+    "operations_chat_date_id_idx": "operations",
+    "digest_subscriptions_period_idx": "digest_subscriptions",
+}
+
+# Запросы - аналоги запросов из repository.py. Многошаговые запросы
+# PostgreSQL (CTE с INSERT/UPDATE) здесь выполняются несколькими
+# выражениями в одной транзакции.
+
+USER_EXISTS = "SELECT 1 FROM users WHERE chat_id = ?1"
+REGISTER_USER = (
+    "INSERT INTO users (chat_id, name) VALUES (?1, ?2) "
+    "ON CONFLICT DO NOTHING RETURNING chat_id"
+)
+
+RECENT_OPERATIONS = (
+    "SELECT id, type_operation, sum, date FROM operations "
+    "WHERE chat_id = ?1 ORDER BY date DESC, id DESC LIMIT ?2"
+)
+OPERATIONS_PAGE_OLDER = (
+    "SELECT id, type_operation, sum, date FROM operations "
+    "WHERE chat_id = ?1 AND (date, id) < (?2, ?3) "
+    "ORDER BY date DESC, id DESC LIMIT ?4"
+)
+OPERATIONS_PAGE_NEWER = (
+    "SELECT id, type_operation, sum, date FROM operations "
+    "WHERE chat_id = ?1 AND (date, id) > (?2, ?3) "
+    "ORDER BY date, id LIMIT ?4"
+)
+
+DAILY_TOTALS_UPSERT = (
+    "INSERT INTO daily_totals (chat_id, date, income, expense, operations) "
+    "VALUES (?1, ?2, ?3, ?4, ?5) "
+    "ON CONFLICT (chat_id, date) DO UPDATE SET "
+    "income = daily_totals.income + excluded.income, "
+    "expense = daily_totals.expense + excluded.expense, "
+    "operations = daily_totals.operations + excluded.operations"
+)
+BALANCE_UPSERT = (
+    "INSERT INTO balances (chat_id, income, expense, operations) "
+    "VALUES (?1, ?2, ?3, ?4) "
+    "ON CONFLICT (chat_id) DO UPDATE SET "
+    "income = balances.income + excluded.income, "
+    "expense = balances.expense + excluded.expense, "
+    "operations = balances.operations + excluded.operations, "
+    "updated_at = CURRENT_TIMESTAMP"
+)
+INSERT_OPERATION = (
+    "INSERT INTO operations (chat_id, type_operation, sum, date) "
+    "VALUES (?1, ?2, ?3, ?4) RETURNING id"
+)
+OPERATION_AMOUNT = "SELECT sum FROM operations WHERE id = ?1 AND chat_id = ?2"
+UPDATE_OPERATION_AMOUNT = (
+    "UPDATE operations SET sum = ?1 WHERE id = ?2 AND chat_id = ?3 "
+    "RETURNING type_operation, sum, date AS \"date [DATE]\""
+)
+UPDATE_BALANCE = (
+    "UPDATE balances SET income = income + ?2, expense = expense + ?3, "
+    "updated_at = CURRENT_TIMESTAMP WHERE chat_id = ?1"
+)
+
+BALANCE = "SELECT income, expense, operations, updated_at FROM balances WHERE chat_id = ?1"
+# Суммы хранятся как REAL, поэтому сравниваются с допуском на округление
+BALANCE_DRIFT = (
+    "SELECT COALESCE(a.chat_id, b.chat_id) AS chat_id "
+    "FROM (SELECT chat_id, "
+    "COALESCE(SUM(sum) FILTER (WHERE type_operation = 'income'), 0) AS income, "
+    "COALESCE(SUM(sum) FILTER (WHERE type_operation = 'expense'), 0) AS expense, "
+    "COUNT(*) AS operations "
+    "FROM operations GROUP BY chat_id) a "
+    "FULL JOIN balances b ON b.chat_id = a.chat_id "
+    "WHERE ABS(COALESCE(a.income, 0) - COALESCE(b.income, 0)) > 1e-6 "
+    "OR ABS(COALESCE(a.expense, 0) - COALESCE(b.expense, 0)) > 1e-6 "
+    "OR COALESCE(a.operations, 0) <> COALESCE(b.operations, 0)"
+)
+FIX_BALANCE = (
+    "INSERT INTO balances (chat_id, income, expense, operations) "
+    "SELECT ?1, "
+    "COALESCE(SUM(sum) FILTER (WHERE type_operation = 'income'), 0), "
+    "COALESCE(SUM(sum) FILTER (WHERE type_operation = 'expense'), 0), "
+    "COUNT(*) "
+    "FROM operations WHERE chat_id = ?1 "
+    "ON CONFLICT (chat_id) DO UPDATE SET "
+    "income = excluded.income, expense = excluded.expense, "
+    "operations = excluded.operations, updated_at = CURRENT_TIMESTAMP "
+    "WHERE ABS(balances.income - excluded.income) > 1e-6 "
+    "OR ABS(balances.expense - excluded.expense) > 1e-6 "
+    "OR balances.operations <> excluded.operations "
+    "RETURNING chat_id"
+)
+
+GET_DIGEST = "SELECT period FROM digest_subscriptions WHERE chat_id = ?1"
+SET_DIGEST = (
+    "INSERT INTO digest_subscriptions (chat_id, period, last_sent_at) VALUES (?1, ?2, ?3) "
+    "ON CONFLICT (chat_id) DO UPDATE SET period = excluded.period, last_sent_at = excluded.last_sent_at"
+)
+DELETE_DIGEST = "DELETE FROM digest_subscriptions WHERE chat_id = ?1"
+CLAIM_DIGESTS = (
+    "UPDATE digest_subscriptions SET last_sent_at = ?2 "
+    "WHERE period = ?1 AND (last_sent_at IS NULL OR last_sent_at < ?2) "
+    "RETURNING chat_id"
+)
+# Итоги по списку chat_id (JSON-массив в ?1) за [?3, ?2)
+DIGEST_TOTALS = (
+    "SELECT due.value AS chat_id, "
+    "COALESCE(SUM(t.income), 0) AS income, "
+    "COALESCE(SUM(t.expense), 0) AS expense, "
+    "COALESCE(SUM(t.operations), 0) AS operations "
+    "FROM json_each(?1) due LEFT JOIN daily_totals t "
+    "ON t.chat_id = due.value AND t.date >= ?3 AND t.date < ?2 "
+    "GROUP BY due.value"
+)
+
+# Начало интервала сводки, как date_trunc в PostgreSQL (неделя - с понедельника)
+BUCKET_EXPRESSIONS = {
+    "day": "date",
+    "week": "date(date, 'weekday 0', '-6 days')",
+    "month": "date(date, 'start of month')",
+}
+# Вместо ROLLUP - строка итогов (bucket = NULL) и разбивка через UNION ALL
+_SUMMARY = (
+    "SELECT NULL AS \"bucket [DATE]\", "
+    "COALESCE(SUM(income), 0) AS income, "
+    "COALESCE(SUM(expense), 0) AS expense, "
+    "COALESCE(SUM(operations), 0) AS operations "
+    "FROM daily_totals WHERE chat_id = ?1{period} "
+    "UNION ALL "
+    "SELECT {bucket}, SUM(income), SUM(expense), SUM(operations) "
+    "FROM daily_totals WHERE chat_id = ?1{period} "
+    "GROUP BY 1 ORDER BY 1"
+)
+SUMMARY = {bucket: _SUMMARY.format(bucket=expression, period="")
+           for bucket, expression in BUCKET_EXPRESSIONS.items()}
+SUMMARY_FOR_PERIOD = {bucket: _SUMMARY.format(bucket=expression, period=" AND date >= ?2")
+                      for bucket, expression in BUCKET_EXPRESSIONS.items()}
+DAILY_TOTALS = (
+    "SELECT date, income, expense, operations FROM daily_totals "
+    "WHERE chat_id = ?1 ORDER BY date"
+)
+DAILY_TOTALS_FOR_PERIOD = (
+    "SELECT date, income, expense, operations FROM daily_totals "
+    "WHERE chat_id = ?1 AND date >= ?2 ORDER BY date"
+)
+
+OPERATIONS_FOR_PERIOD = (
+    "SELECT id, type_operation, sum, date FROM operations "
+    "WHERE chat_id = ?1 AND date >= ?2 ORDER BY date DESC, id DESC LIMIT ?3"
+)
+OPERATIONS_PAGE_OLDER_FOR_PERIOD = (
+    "SELECT id, type_operation, sum, date FROM operations "
+    "WHERE chat_id = ?1 AND (date, id) < (?2, ?3) AND date >= ?4 "
+    "ORDER BY date DESC, id DESC LIMIT ?5"
+)
+
+EXPORT = (
+    "SELECT date, type_operation, sum FROM operations "
+    "WHERE chat_id = ?1 ORDER BY date, id"
+)
+EXPORT_FOR_PERIOD = (
+    "SELECT date, type_operation, sum FROM operations "
+    "WHERE chat_id = ?1 AND date >= ?2 ORDER BY date, id"
+)
+EXPORT_COLUMNS = ("date", "type_operation", "sum")
+
+# Сколько строк читается из курсора выгрузки за один раз
+CURSOR_PREFETCH = 500
+# Сколько операций подробного отчета читается за один запрос
+REPORT_PAGE_SIZE = 500
+
+
+def _since(period: timedelta) -> str:
+    """Граница периода для сравнения с датой, как date >= NOW() - interval
+    в PostgreSQL: '2025-01-02' >= '2025-01-01 12:00:00', а '2025-01-01' - нет"""
+    return (datetime.now() - period).isoformat(" ", "seconds")
+
+
+class SQLitePool:
+    """Подключения к файлу SQLite в режиме WAL.
+
+    Запись идет через одно подключение под блокировкой (SQLite допускает
+    только одного пишущего), чтение - через size подключений только для
+    чтения, которые в режиме WAL не ждут записи и друг друга.
+    """
+
+    def __init__(self, path: str, size: int = 5, busy_timeout: float = 5.0):
+        self.path = path
+        self.size = size
+        self.busy_timeout = busy_timeout
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._write_lock = asyncio.Lock()
+        self._readers: asyncio.Queue = asyncio.Queue()
+        self._connections: List[aiosqlite.Connection] = []
+
+    async def _connect(self, read_only: bool) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(
+            self.path,
+            isolation_level=None,
+            detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES
+        )
+        conn.row_factory = sqlite3.Row
+        # executescript сразу завершает выражения: PRAGMA, возвращающая
+        # строку, иначе остается активной и держит блокировку
+        await conn.executescript(
+            # Режим журнала сохраняется в файле базы
+            ("PRAGMA query_only = ON; " if read_only else "PRAGMA journal_mode = WAL; ")
+            + f"PRAGMA busy_timeout = {int(self.busy_timeout * 1000)}; "
+            "PRAGMA synchronous = NORMAL; "
+            "PRAGMA temp_store = MEMORY"
+        )
+        self._connections.append(conn)
+        return conn
+
+    async def open(self) -> "SQLitePool":
+        self._writer = await self._connect(read_only=False)
+        for _ in range(self.size):
+            self._readers.put_nowait(await self._connect(read_only=True))
+        return self
+
+    @asynccontextmanager
+    async def acquire(self, timeout: Optional[float] = None) -> AsyncIterator[aiosqlite.Connection]:
+        """Подключение для чтения"""
+        conn = await asyncio.wait_for(self._readers.get(), timeout)
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+
+    @asynccontextmanager
+    async def transaction(self, timeout: Optional[float] = None) -> AsyncIterator[aiosqlite.Connection]:
+        """Подключение для записи внутри транзакции BEGIN IMMEDIATE"""
+        await asyncio.wait_for(self._write_lock.acquire(), timeout)
+        try:
+            await self._writer.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._writer
+            except BaseException:
+                await self._writer.execute("ROLLBACK")
+                raise
+            await self._writer.execute("COMMIT")
+        finally:
+            self._write_lock.release()
+
+    # Те же методы, что у asyncpg.Pool, - для метрик пула
+    def get_size(self) -> int:
+        return len(self._connections)
+
+    def get_idle_size(self) -> int:
+        return self._readers.qsize() + (0 if self._write_lock.locked() else 1)
+
+    def get_max_size(self) -> int:
+        return self.size + 1
+
+    async def close(self):
+        for conn in self._connections:
+            await conn.close()
+        self._connections.clear()
+
+
+async def create_sqlite_pool(path: str, size: int = 5, busy_timeout: float = 5.0) -> SQLitePool:
+    return await SQLitePool(path, size, busy_timeout).open()
+
+
+async def run_sqlite_migrations(pool: SQLitePool) -> List[int]:
+    """Применяет недостающие миграции. Возвращает номера примененных версий"""
+    async with pool.transaction() as conn:
+        await conn.execute(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            "version INTEGER PRIMARY KEY, "
+            "name TEXT NOT NULL, "
+            "applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP)"
+        )
+
+    done = []
+    for version, name, statements in MIGRATIONS:
+        # BEGIN IMMEDIATE блокирует запись и для других процессов,
+        # поэтому проверка и применение миграции не пересекаются
+        async with pool.transaction() as conn:
+            applied = await conn.execute_fetchall(
+                "SELECT 1 FROM schema_migrations WHERE version = ?1", (version,)
+            )
+            if applied:
+                continue
+            for statement in statements:
+                await conn.execute(statement)
+            await conn.execute(
+                "INSERT INTO schema_migrations (version, name) VALUES (?1, ?2)", (version, name)
+            )
+        logger.info(f"Применена миграция {version}: {name}")
+        done.append(version)
+    return done
+
+
+async def find_missing_sqlite_indexes(pool: SQLitePool) -> List[str]:
+    """Возвращает ожидаемые индексы, которых нет в базе"""
+    async with pool.acquire() as conn:
+        existing = {row[0] for row in await conn.execute_fetchall(
+            "SELECT name FROM sqlite_master WHERE type = 'index'"
+        )}
+    return [name for name in EXPECTED_INDEXES if name not in existing]
+
+
+class SQLiteRepository:
+    """Работа с пользователями и операциями во встроенной базе SQLite.
+
+    Повторяет интерфейс FinanceRepository для установки на одном сервере
+    без PostgreSQL. Чтение идет параллельно через подключения для чтения,
+    все изменения - через одно подключение для записи.
+    """
+
+    def __init__(self, pool: SQLitePool, acquire_timeout: Optional[float] = None):
+        self.pool = pool
+        self.acquire_timeout = acquire_timeout
+
+    def _acquire(self):
+        return self.pool.acquire(timeout=self.acquire_timeout)
+
+    def _transaction(self):
+        return self.pool.transaction(timeout=self.acquire_timeout)
+
+    @staticmethod
+    async def _fetchval(conn: aiosqlite.Connection, query: str, *args):
+        async with conn.execute(query, args) as cursor:
+            row = await cursor.fetchone()
+        return row[0] if row is not None else None
+
+    # Пользователи
+    @timed_query
+    async def is_registered(self, chat_id: int) -> bool:
+        async with self._acquire() as conn:
+            return await self._fetchval(conn, USER_EXISTS, chat_id) is not None
+
+    @timed_query
+    async def register_user(self, chat_id: int, name: str) -> bool:
+        """Регистрирует пользователя. Возвращает False, если он уже был зарегистрирован"""
+        async with self._transaction() as conn:
+            return await self._fetchval(conn, REGISTER_USER, chat_id, name) is not None
+
+    # Операции
+    @timed_query
+    async def operations_page(self, chat_id: int, cursor: Optional[Tuple[date, int]] = None,
+                              older: bool = True, limit: int = 10) -> Tuple[List[sqlite3.Row], bool]:
+        """Страница операций (новые сверху) старше или новее курсора (date, id)"""
+        async with self._acquire() as conn:
+            if cursor is None:
+                rows = await conn.execute_fetchall(RECENT_OPERATIONS, (chat_id, limit + 1))
+            elif older:
+                rows = await conn.execute_fetchall(OPERATIONS_PAGE_OLDER, (chat_id, *cursor, limit + 1))
+            else:
+                rows = await conn.execute_fetchall(OPERATIONS_PAGE_NEWER, (chat_id, *cursor, limit + 1))
+
+        rows = list(rows)
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if cursor is not None and not older:
+            rows.reverse()
+        return rows, has_more
+
+    @timed_query
+    async def add_operation(self, chat_id: int, type_operation: str, amount, operation_date) -> int:
+        """Сохраняет операцию и обновляет итоги дня и баланс. Возвращает ID операции"""
+        income, expense = (amount, 0) if type_operation == 'income' else (0, amount)
+        async with self._transaction() as conn:
+            operation_id = await self._fetchval(
+                conn, INSERT_OPERATION, chat_id, type_operation, amount, operation_date
+            )
+            await conn.execute(DAILY_TOTALS_UPSERT, (chat_id, operation_date, income, expense, 1))
+            await conn.execute(BALANCE_UPSERT, (chat_id, income, expense, 1))
+        return operation_id
+
+    @timed_query
+    async def update_operation_amount(self, operation_id: int, chat_id: int,
+                                      amount) -> Optional[sqlite3.Row]:
+        """Меняет сумму операции пользователя и возвращает обновленную операцию
+        (или None, если операция не найдена)"""
+        async with self._transaction() as conn:
+            old_amount = await self._fetchval(conn, OPERATION_AMOUNT, operation_id, chat_id)
+            if old_amount is None:
+                return None
+            async with conn.execute(UPDATE_OPERATION_AMOUNT, (amount, operation_id, chat_id)) as cursor:
+                operation = await cursor.fetchone()
+            delta = operation['sum'] - old_amount
+            income, expense = (delta, 0) if operation['type_operation'] == 'income' else (0, delta)
+            await conn.execute(DAILY_TOTALS_UPSERT, (chat_id, operation['date'], income, expense, 0))
+            await conn.execute(UPDATE_BALANCE, (chat_id, income, expense))
+        return operation
+
+    @timed_query
+    async def save_operations(self, operations: List[tuple]):
+        """Пакетно сохраняет операции (chat_id, type_operation, sum, date)
+        вместе с дневными итогами и балансами в одной транзакции"""
+        totals = {}
+        balances = {}
+        for chat_id, type_operation, amount, operation_date in operations:
+            income, expense = (amount, 0) if type_operation == 'income' else (0, amount)
+            for target, key in ((totals, (chat_id, operation_date)), (balances, chat_id)):
+                total_income, total_expense, count = target.get(key, (0, 0, 0))
+                target[key] = (total_income + income, total_expense + expense, count + 1)
+
+        async with self._transaction() as conn:
+            await conn.executemany(
+                "INSERT INTO operations (chat_id, type_operation, sum, date) VALUES (?1, ?2, ?3, ?4)",
+                operations
+            )
+            await conn.executemany(
+                DAILY_TOTALS_UPSERT,
+                [(chat_id, operation_date, income, expense, count)
+                 for (chat_id, operation_date), (income, expense, count) in totals.items()]
+            )
+            await conn.executemany(
+                BALANCE_UPSERT,
+                [(chat_id, income, expense, count)
+                 for chat_id, (income, expense, count) in balances.items()]
+            )
+
+    # Баланс
+    @timed_query
+    async def get_balance(self, chat_id: int) -> Optional[sqlite3.Row]:
+        """Доходы, расходы и число операций пользователя (None, если операций не было)"""
+        async with self._acquire() as conn:
+            async with conn.execute(BALANCE, (chat_id,)) as cursor:
+                return await cursor.fetchone()
+
+    @timed_query
+    async def reconcile_balances(self) -> List[int]:
+        """Сверяет балансы с таблицей operations и исправляет расхождения.
+        Возвращает chat_id, у которых баланс действительно отличался"""
+        async with self._acquire() as conn:
+            suspects = [row['chat_id'] for row in await conn.execute_fetchall(BALANCE_DRIFT)]
+        fixed = []
+        for chat_id in suspects:
+            async with self._transaction() as conn:
+                if await self._fetchval(conn, FIX_BALANCE, chat_id) is not None:
+                    fixed.append(chat_id)
+        return fixed
+
+    # Дайджесты
+    @timed_query
+    async def get_digest(self, chat_id: int) -> Optional[str]:
+        async with self._acquire() as conn:
+            return await self._fetchval(conn, GET_DIGEST, chat_id)
+
+    @timed_query
+    async def set_digest(self, chat_id: int, period: Optional[str], current_start: Optional[date] = None):
+        """Подписывает на дайджест за период week/month (None - отписка).
+        Первый дайджест придет за период, следующий за current_start"""
+        async with self._transaction() as conn:
+            if period is None:
+                await conn.execute(DELETE_DIGEST, (chat_id,))
+            else:
+                await conn.execute(SET_DIGEST, (chat_id, period, current_start))
+
+    @timed_query
+    async def claim_digests(self, period: str, start: date, previous_start: date) -> List[sqlite3.Row]:
+        """Забирает неотправленные дайджесты за [previous_start, start) с итогами"""
+        async with self._transaction() as conn:
+            due = [row[0] for row in await conn.execute_fetchall(CLAIM_DIGESTS, (period, start))]
+            if not due:
+                return []
+            return list(await conn.execute_fetchall(DIGEST_TOTALS, (json.dumps(due), start, previous_start)))
+
+    # Отчеты
+    @timed_query
+    async def fetch_summary(self, chat_id: int, bucket: str,
+                            period: Optional[timedelta]) -> List[sqlite3.Row]:
+        """Итоги и разбивка по интервалам. Первая строка - итоги за период.
+        Если операций нет, возвращает пустой список"""
+        async with self._acquire() as conn:
+            if period is None:
+                rows = await conn.execute_fetchall(SUMMARY[bucket], (chat_id,))
+            else:
+                rows = await conn.execute_fetchall(SUMMARY_FOR_PERIOD[bucket], (chat_id, _since(period)))
+
+        rows = list(rows)
+        if not rows or rows[0]['operations'] == 0:
+            return []
+        return rows
+
+    @timed_query
+    async def fetch_daily_totals(self, chat_id: int,
+                                 period: Optional[timedelta]) -> List[sqlite3.Row]:
+        """Итоги по дням за период (старые сверху)"""
+        async with self._acquire() as conn:
+            if period is None:
+                return list(await conn.execute_fetchall(DAILY_TOTALS, (chat_id,)))
+            return list(await conn.execute_fetchall(DAILY_TOTALS_FOR_PERIOD, (chat_id, _since(period))))
+
+    @timed_query
+    async def iter_operations(self, chat_id: int,
+                              period: Optional[timedelta]) -> AsyncIterator[sqlite3.Row]:
+        """Отдает операции за период (новые сверху) страницами по REPORT_PAGE_SIZE.
+        Подключение занято только на время чтения страницы"""
+        since = _since(period) if period is not None else None
+        cursor = None
+        while True:
+            async with self._acquire() as conn:
+                if cursor is None and since is None:
+                    rows = await conn.execute_fetchall(RECENT_OPERATIONS, (chat_id, REPORT_PAGE_SIZE))
+                elif cursor is None:
+                    rows = await conn.execute_fetchall(OPERATIONS_FOR_PERIOD, (chat_id, since, REPORT_PAGE_SIZE))
+                elif since is None:
+                    rows = await conn.execute_fetchall(OPERATIONS_PAGE_OLDER,
+                                                       (chat_id, *cursor, REPORT_PAGE_SIZE))
+                else:
+                    rows = await conn.execute_fetchall(OPERATIONS_PAGE_OLDER_FOR_PERIOD,
+                                                       (chat_id, *cursor, since, REPORT_PAGE_SIZE))
+            rows = list(rows)
+            for row in rows:
+                yield row
+            if len(rows) < REPORT_PAGE_SIZE:
+                return
+            cursor = (rows[-1]['date'], rows[-1]['id'])
+
+    @timed_query
+    async def export_operations(self, chat_id: int, period: Optional[timedelta],
+                                compress: bool = False) -> bytes:
+        """Выгружает операции за период в CSV (как COPY ... CSV HEADER).
+        Строки читаются порциями и сразу пишутся в буфер"""
+        buffer = io.BytesIO()
+        compressor = zlib.compressobj(wbits=31) if compress else None
+        text = io.StringIO()
+        writer = csv.writer(text, lineterminator="\n")
+
+        def flush():
+            chunk = text.getvalue().encode()
+            buffer.write(compressor.compress(chunk) if compressor else chunk)
+            text.seek(0)
+            text.truncate()
+
+        writer.writerow(EXPORT_COLUMNS)
+        async with self._acquire() as conn:
+            if period is None:
+                cursor = await conn.execute(EXPORT, (chat_id,))
+            else:
+                cursor = await conn.execute(EXPORT_FOR_PERIOD, (chat_id, _since(period)))
+            async with cursor:
+                while rows := await cursor.fetchmany(CURSOR_PREFETCH):
+                    writer.writerows(rows)
+                    flush()
+        flush()
+
+        if compressor:
+            buffer.write(compressor.flush())
+        return buffer.getvalue()
@@ -0,0 +1,119 @@
+import time
+import asyncio
+import logging
+from typing import List, Optional, Tuple
+
+from repository import FinanceRepository
+
+logger = logging.getLogger(__name__)
+
+
+class OperationWriter:
+    """Очередь отложенной записи операций.
+
+    Операции от разных пользователей копятся в очереди и сохраняются
+    пачками: пачка закрывается, когда в ней max_batch операций или
+    с момента первой операции прошло max_delay секунд.
+    add() возвращает управление только после фиксации транзакции с пачкой.
+    """
+
+    def __init__(self, repo: FinanceRepository, max_batch: int = 500, max_delay: float = 0.05):
+        self.repo = repo
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+        self._flushing: Optional[asyncio.Task] = None
+        self._added = asyncio.Event()
+        # Метрики
+        self.batches_total = 0
+        self.operations_total = 0
+        self.failed_batches_total = 0
+        self.last_batch_size = 0
+        self.max_batch_size = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Останавливает запись, предварительно сохранив все накопленные операции"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        if self._flushing is not None:
+            await self._flushing
+
+        while not self._queue.empty():
+            await self._flush(self._take_batch(self.max_batch))
+
+    async def add(self, chat_id: int, type_operation: str, amount, operation_date):
+        """Ставит операцию в очередь и ждет, пока пачка с ней будет сохранена"""
+        if self._task is None:
+            raise RuntimeError("OperationWriter не запущен")
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(((chat_id, type_operation, amount, operation_date), future))
+        self._added.set()
+        await future
+
+    def _take_batch(self, limit: int) -> List[Tuple[tuple, asyncio.Future]]:
+        batch = []
+        while len(batch) < limit and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            try:
+                await self._collect(batch)
+            finally:
+                # Собранная пачка сохраняется, даже если запись останавливают
+                self._flushing = asyncio.create_task(self._flush(batch))
+            await asyncio.shield(self._flushing)
+
+    async def _collect(self, batch: List[Tuple[tuple, asyncio.Future]]):
+        """Добирает пачку до max_batch операций, но не дольше max_delay секунд"""
+        deadline = time.monotonic() + self.max_delay
+        while True:
+            self._added.clear()
+            batch.extend(self._take_batch(self.max_batch - len(batch)))
+            timeout = deadline - time.monotonic()
+            if len(batch) >= self.max_batch or timeout <= 0:
+                return
+            # Ждем новых операций или истечения времени
+            try:
+                await asyncio.wait_for(self._added.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _flush(self, batch: List[Tuple[tuple, asyncio.Future]]):
+        if not batch:
+            return
+        try:
+            await self.repo.save_operations([operation for operation, _ in batch])
+        except Exception as e:
+            self.failed_batches_total += 1
+            logger.error(f"Ошибка при сохранении пачки из {len(batch)} операций: {str(e)}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        self.batches_total += 1
+        self.operations_total += len(batch)
+        self.last_batch_size = len(batch)
+        self.max_batch_size = max(self.max_batch_size, len(batch))
+        logger.debug(f"Сохранена пачка из {len(batch)} операций, в очереди {self.queue_depth}")
+        for _, future in batch:
+            if not future.done():
+                future.set_result(None)
@@ -0,0 +1,257 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+from datetime import timedelta
+from typing import Any, Dict, List, Mapping, Optional
+
+import asyncpg
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+logger = logging.getLogger(__name__)
+
+
+def dumps(data: Mapping[str, Any]) -> str:
+    """Компактная сериализация данных состояния (без пробелов и \\u-экранирования)"""
+    return json.dumps(data, separators=(',', ':'), ensure_ascii=False)
+
+
+class PostgresStorage(BaseStorage):
+    """Хранилище FSM в таблице PostgreSQL.
+
+    Состояние и данные всех процессов бота лежат в одной таблице,
+    поэтому бот можно запускать в нескольких экземплярах.
+    Записи, которые не менялись дольше ttl секунд, считаются устаревшими
+    и удаляются при записи не чаще раза в purge_interval секунд.
+    """
+
+    def __init__(self, connect_kwargs: Dict[str, Any], ttl: Optional[int] = None,
+                 table: str = "fsm_storage", pool_size: int = 5, purge_interval: float = 300):
+        self.connect_kwargs = connect_kwargs
+        self.ttl = ttl
+        self.table = table
+        self.pool_size = pool_size
+        self.purge_interval = purge_interval
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True)
+        self._pool: Optional[asyncpg.Pool] = None
+        self._pool_lock = asyncio.Lock()
+        self._purged_at = 0.0
+
+    async def _get_pool(self) -> asyncpg.Pool:
+        async with self._pool_lock:
+            if self._pool is None:
+                pool = await asyncpg.create_pool(**self.connect_kwargs, min_size=1, max_size=self.pool_size)
+                async with pool.acquire() as conn:
+                    await conn.execute(
+                        f"CREATE TABLE IF NOT EXISTS {self.table} ("
+                        "key TEXT PRIMARY KEY, "
+                        "state TEXT, "
+                        "data TEXT, "
+                        "expires_at TIMESTAMPTZ)"
+                    )
+                    await conn.execute(
+                        f"CREATE INDEX IF NOT EXISTS {self.table}_expires_at_idx ON {self.table} (expires_at)"
+                    )
+                self._pool = pool
+            return self._pool
+
+    async def purge(self) -> int:
+        """Удаляет устаревшие записи. Возвращает, сколько удалено"""
+        pool = await self._get_pool()
+        self._purged_at = time.monotonic()
+        result = await pool.execute(f"DELETE FROM {self.table} WHERE expires_at < NOW()")
+        return int(result.split()[-1])
+
+    async def _maybe_purge(self):
+        if self.ttl and time.monotonic() - self._purged_at >= self.purge_interval:
+            try:
+                await self.purge()
+            except Exception as e:
+                logger.error(f"Ошибка при удалении устаревших состояний FSM: {str(e)}")
+
+    async def _upsert(self, key: StorageKey, column: str, value: Optional[str]):
+        """Записывает state или data. Вторая колонка устаревшей записи
+        очищается, а запись без состояния и данных удаляется"""
+        pool = await self._get_pool()
+        await self._maybe_purge()
+        other = "data" if column == "state" else "state"
+        if value is None:
+            await pool.execute(
+                f"WITH gone AS ("
+                f"DELETE FROM {self.table} WHERE key = $1 "
+                f"AND ({other} IS NULL OR expires_at < NOW()) RETURNING key) "
+                f"UPDATE {self.table} SET {column} = NULL, expires_at = NOW() + $2::interval "
+                "WHERE key = $1 AND NOT EXISTS (SELECT 1 FROM gone)",
+                self.key_builder.build(key), self._ttl_interval()
+            )
+            return
+        await pool.execute(
+            f"INSERT INTO {self.table} (key, {column}, expires_at) "
+            "VALUES ($1, $2, NOW() + $3::interval) "
+            f"ON CONFLICT (key) DO UPDATE SET {column} = EXCLUDED.{column}, "
+            f"{other} = CASE WHEN {self.table}.expires_at < NOW() THEN NULL ELSE {self.table}.{other} END, "
+            "expires_at = EXCLUDED.expires_at",
+            self.key_builder.build(key), value, self._ttl_interval()
+        )
+
+    async def _select(self, key: StorageKey, column: str) -> Optional[str]:
+        pool = await self._get_pool()
+        return await pool.fetchval(
+            f"SELECT {column} FROM {self.table} "
+            "WHERE key = $1 AND (expires_at IS NULL OR expires_at > NOW())",
+            self.key_builder.build(key)
+        )
+
+    def _ttl_interval(self) -> Optional[timedelta]:
+        return timedelta(seconds=self.ttl) if self.ttl else None
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await self._upsert(key, "state", state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return await self._select(key, "state")
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        await self._upsert(key, "data", dumps(data) if data else None)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        value = await self._select(key, "data")
+        return json.loads(value) if value else {}
+
+    async def close(self) -> None:
+        if self._pool is not None:
+            await self._pool.close()
+
+
+def _redis_storage(redis, ttl: Optional[int]) -> BaseStorage:
+    from aiogram.fsm.storage.redis import RedisStorage
+
+    return RedisStorage(
+        redis,
+        key_builder=DefaultKeyBuilder(with_bot_id=True),
+        state_ttl=ttl,
+        data_ttl=ttl,
+        json_dumps=dumps
+    )
+
+
+def create_fsm_storage(db_config: Optional[Dict[str, Any]] = None) -> BaseStorage:
+    """Создает хранилище FSM по переменной окружения FSM_STORAGE.
+
+    memory   - в памяти процесса (по умолчанию, состояние теряется при перезапуске);
+    redis    - Redis по адресу FSM_REDIS_URL;
+    postgres - таблица fsm_storage в базе из db_config.
+    FSM_STATE_TTL задает время жизни записей в секундах.
+    """
+    backend = os.getenv('FSM_STORAGE', 'memory').lower()
+    ttl = int(os.getenv('FSM_STATE_TTL', '86400')) or None
+
+    if backend == 'redis':
+        from redis.asyncio import Redis
+
+        return _redis_storage(Redis.from_url(os.getenv('FSM_REDIS_URL', 'redis://localhost:6379/0')), ttl)
+
+    if backend == 'postgres':
+        if db_config is None:
+            raise ValueError("Для FSM_STORAGE=postgres нужны настройки базы данных")
+        return PostgresStorage(db_config, ttl=ttl)
+
+    if backend != 'memory':
+        logger.warning(f"Неизвестное хранилище FSM '{backend}', используется memory")
+    return MemoryStorage()
+
+
+async def check_storage(storage: BaseStorage, ttl: Optional[int] = None) -> List[str]:
+    """Проверяет поведение хранилища на служебном ключе. Возвращает найденные ошибки.
+
+    С ttl проверяется и то, что устаревшие состояние и данные не возвращаются
+    и не оживают при следующей записи (проверка ждет ttl секунд).
+    """
+    key = StorageKey(bot_id=0, chat_id=-1, user_id=-1)
+    problems = []
+
+    def expect(actual, expected, what: str):
+        if actual != expected:
+            problems.append(f"{what}: ожидалось {expected!r}, получено {actual!r}")
+
+    await storage.set_state(key, None)
+    await storage.set_data(key, {})
+
+    await storage.set_state(key, "Check:state")
+    expect(await storage.get_state(key), "Check:state", "состояние после записи")
+    await storage.set_data(key, {"id": 1, "текст": "данные"})
+    expect(await storage.get_data(key), {"id": 1, "текст": "данные"}, "данные после записи")
+    await storage.set_state(key, None)
+    expect(await storage.get_state(key), None, "состояние после очистки")
+    expect(await storage.get_data(key), {"id": 1, "текст": "данные"}, "данные после очистки состояния")
+    await storage.set_data(key, {})
+    expect(await storage.get_data(key), {}, "данные после очистки")
+
+    if ttl:
+        await storage.set_state(key, "Check:old")
+        await storage.set_data(key, {"old": True})
+        await asyncio.sleep(ttl + 1)
+        expect(await storage.get_state(key), None, "устаревшее состояние")
+        expect(await storage.get_data(key), {}, "устаревшие данные")
+        await storage.set_state(key, "Check:new")
+        expect(await storage.get_data(key), {}, "данные после записи состояния поверх устаревшей записи")
+
+    await storage.set_state(key, None)
+    await storage.set_data(key, {})
+    return problems
+
+
+async def main(backend: str):
+    """Проверка хранилища: python -m common.fsm_storage memory|fakeredis|redis|postgres.
+
+    Для postgres нужны переменные DB_*, для redis - FSM_REDIS_URL.
+    Код возврата 1, если хранилище ведет себя неправильно.
+    """
+    ttl = 1
+    if backend == 'fakeredis':
+        from fakeredis import FakeAsyncRedis
+
+        storage = _redis_storage(FakeAsyncRedis(), ttl)
+    else:
+        os.environ['FSM_STORAGE'] = backend
+        os.environ['FSM_STATE_TTL'] = str(ttl)
+        storage = create_fsm_storage({
+            'host': os.getenv('DB_HOST'),
+            'port': os.getenv('DB_PORT'),
+            'user': os.getenv('DB_USER'),
+            'password': os.getenv('DB_PASSWORD'),
+            'database': os.getenv('DB_NAME')
+        })
+    try:
+        # В памяти процесса записи не устаревают
+        problems = await check_storage(storage, None if isinstance(storage, MemoryStorage) else ttl)
+        if isinstance(storage, PostgresStorage) and not problems:
+            # Очищенная запись удаляется сразу, устаревшая - при очистке
+            await storage.set_state(StorageKey(bot_id=0, chat_id=-2, user_id=-2), "Check:old")
+            await asyncio.sleep(ttl + 1)
+            if not await storage.purge():
+                problems.append("устаревшая запись не удалена при очистке")
+            pool = await storage._get_pool()
+            left = await pool.fetchval(f"SELECT COUNT(*) FROM {storage.table} WHERE key LIKE '0:-%'")
+            if left:
+                problems.append(f"после проверки в таблице осталось записей: {left}")
+    finally:
+        await storage.close()
+
+    for problem in problems:
+        print(f"❌ {problem}")
+    if problems:
+        sys.exit(1)
+    print(f"✅ Хранилище FSM {backend} работает правильно")
+
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main(sys.argv[1] if len(sys.argv) > 1 else os.getenv('FSM_STORAGE', 'memory')))
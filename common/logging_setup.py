@@ -0,0 +1,112 @@
+import os
+import copy
+import json
+import queue
+import atexit
+import random
+import logging
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Iterable, Optional
+
+DEFAULT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+# Пометка для частых сообщений об успехе, которые можно прореживать:
+# logger.info("...", extra=SAMPLED)
+SAMPLED = {"sampled": True}
+
+_listener: Optional[QueueListener] = None
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись журнала - одна строка JSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data["exception"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False)
+
+
+class _QueueHandler(QueueHandler):
+    """В очередь попадает запись с готовым текстом сообщения и исключения,
+    а оформление (text или json) выполняется в потоке записи"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class SamplingFilter(logging.Filter):
+    """Пропускает только долю rate сообщений уровня INFO и ниже,
+    помеченных SAMPLED или пришедших от логгеров из loggers.
+    Предупреждения и ошибки проходят всегда."""
+
+    def __init__(self, rate: float, loggers: Iterable[str] = ()):
+        super().__init__()
+        self.rate = rate
+        self.loggers = tuple(loggers)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.rate >= 1 or record.levelno > logging.INFO:
+            return True
+        if getattr(record, "sampled", False) or record.name.startswith(self.loggers):
+            return random.random() < self.rate
+        return True
+
+
+def setup_logging(log_file: str, level: Optional[str] = None) -> QueueListener:
+    """Настраивает неблокирующее логирование.
+
+    Обработчики корневого логгера только кладут записи в очередь,
+    запись в файл (с ротацией по размеру) и на консоль выполняет
+    отдельный поток QueueListener. Параметры берутся из окружения:
+    LOG_LEVEL, LOG_FORMAT (text или json), LOG_MAX_BYTES, LOG_BACKUP_COUNT,
+    LOG_SAMPLE_RATE (доля сохраняемых частых сообщений) и LOG_SAMPLED_LOGGERS.
+    """
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    formatter = (JsonFormatter() if os.getenv('LOG_FORMAT', 'text').lower() == 'json'
+                 else logging.Formatter(DEFAULT_FORMAT))
+    file_handler = RotatingFileHandler(
+        log_file,
+        maxBytes=int(os.getenv('LOG_MAX_BYTES', str(10 * 1024 * 1024))),
+        backupCount=int(os.getenv('LOG_BACKUP_COUNT', '5')),
+        encoding='utf-8'
+    )
+    stream_handler = logging.StreamHandler()
+    for handler in (file_handler, stream_handler):
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = _QueueHandler(log_queue)
+    # Лишние записи отбрасываются до постановки в очередь
+    queue_handler.addFilter(SamplingFilter(
+        float(os.getenv('LOG_SAMPLE_RATE', '1')),
+        [name for name in os.getenv('LOG_SAMPLED_LOGGERS', 'aiogram.event').split(',') if name]
+    ))
+
+    logging.basicConfig(
+        level=(level or os.getenv('LOG_LEVEL', 'INFO')).upper(),
+        handlers=[queue_handler],
+        force=True
+    )
+    _listener = QueueListener(log_queue, file_handler, stream_handler, respect_handler_level=True)
+    _listener.start()
+    # Перед выходом дописываем все, что осталось в очереди
+    atexit.register(_listener.stop)
+    return _listener
@@ -1,4 +1,5 @@
 import os
+import sys
 import asyncio
 import logging
 from aiogram import Bot, Dispatcher
@@ -8,15 +9,12 @@ from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import Message
 
+# Общие модули ботов лежат в каталоге common в корне репозитория
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.logging_setup import setup_logging
+
 # Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.FileHandler("bot.log"),  # Запись логов в файл
-        logging.StreamHandler()  # Вывод логов в консоль
-    ]
-)
+setup_logging("bot.log")
 logger = logging.getLogger(__name__)
 
 # Конфигурация бота
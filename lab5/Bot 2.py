@@ -1,21 +1,22 @@
 import os
+import sys
 import asyncio
 import logging
 from aiogram import Bot, Dispatcher, types
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton
 from aiogram.utils.keyboard import ReplyKeyboardBuilder
 import asyncpg
 
+# Общие модули ботов лежат в каталоге common в корне репозитория
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.fsm_storage import create_fsm_storage
+from common.logging_setup import setup_logging
+
 # Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    handlers=[logging.FileHandler("bot.log"), logging.StreamHandler()]
-)
+setup_logging("bot.log")
 logger = logging.getLogger(__name__)
 
 # Конфигурация бота
@@ -35,7 +36,7 @@ DB_CONFIG = {
 
 # Инициализация бота
 bot = Bot(token=API_TOKEN)
-storage = MemoryStorage()
+storage = create_fsm_storage(DB_CONFIG)
 dp = Dispatcher(storage=storage)
 
 # Машина состояний